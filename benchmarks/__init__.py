@@ -0,0 +1,12 @@
+"""Benchmarks of the splitting and faststart code paths.
+
+Run from the top of the source tree:
+
+    python -m benchmarks.run -o results.json
+    python -m benchmarks.run -b results.json
+
+The first command stores the results (in JSON), the second one compares
+a new run against them and exits with a non-zero status if any of the
+benchmarks got slower by more than the tolerance. The test files are
+generated with L{benchmarks.synth}.
+"""
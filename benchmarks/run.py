@@ -0,0 +1,340 @@
+"""Run the benchmarks, store the results and compare them with a
+baseline.
+
+Each benchmark runs in a forked child process, which keeps the peak
+memory measurements of the benchmarks apart: the growth of the maximum
+resident set size of the child over the run is reported, next to the
+best and median times of the repeated runs.
+"""
+
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from mp4seek import async
+from mp4seek import iso
+from mp4seek import vector
+
+from benchmarks import synth
+
+FORMAT = 1
+
+# default tolerance of the baseline comparison - 10% slower at most
+TOLERANCE = 0.1
+
+# test files, as keyword arguments of synth.make (on top of the common
+# ones, see make_files)
+FILES = {
+    'moov_first': dict(moov_first=True),
+    'moov_last': dict(moov_first=False),
+    'co64_runs': dict(co64=True, chunk_run=5, stts_run=11),
+}
+
+
+def make_files(directory, samples, tracks=2, key_interval=25):
+    """Generate the test files in directory.
+
+    @returns: paths of the files, by name
+    @rtype:   dict
+    """
+    paths = {}
+    for name, kw in FILES.items():
+        paths[name] = os.path.join(directory, name + '.mp4')
+        synth.make(paths[name], tracks=tracks, samples=samples,
+                   key_interval=key_interval, **kw)
+    return paths
+
+def _parse(f):
+    aftyp, amoov, alist = iso.read_iso_file(f)
+    for atrak in amoov.trak:
+        stbl = atrak.mdia.minf.stbl
+        for k in stbl._fields:
+            getattr(stbl, k)
+    return amoov
+
+def _load(path):
+    # the file stays open, for the boxes to read their raw data from
+    return _parse(open(path, 'rb'))
+
+def _split_times(amoov, n):
+    duration = amoov.mvhd.duration / float(amoov.mvhd.timescale)
+    return [duration * (i + 1) / (n + 1) for i in xrange(n)]
+
+
+# The benchmarks: called with the test files and the options, they do
+# their set-up and return the function to time, and a dictionary of
+# extra results filled by it (or None).
+
+def bench_read_iso_file(paths, options):
+    """read_iso_file, including parsing all the sample tables"""
+    path = paths['co64_runs']
+    def run():
+        f = open(path, 'rb')
+        try:
+            _parse(f)
+        finally:
+            f.close()
+    return run, None
+
+def bench_find_nearest_syncpoint(paths, options):
+    """building the sync index and 1000 nearest sync point lookups"""
+    amoov = _load(paths['moov_first'])
+    times = _split_times(amoov, 1000)
+    def run():
+        syncs = iso.SyncIndex(amoov)
+        for t in times:
+            iso.find_nearest_syncpoint(amoov, t, syncs)
+    return run, None
+
+def bench_cut_moov(paths, options):
+    """cut_moov at 10 points, header written to memory"""
+    amoov = _load(paths['co64_runs'])
+    times = _split_times(amoov, 10)
+    def run():
+        for t in times:
+            iso.cut_moov(amoov, t)[0].write(_NullFile())
+    return run, None
+
+def bench_split_and_write(paths, options):
+    """split_and_write in the middle of the file, to a file"""
+    path = paths['moov_first']
+    out_path = path + '.split'
+    t = _split_times(_load(path), 1)[0]
+    def run():
+        f, out_f = open(path, 'rb'), open(out_path, 'wb')
+        try:
+            iso.split_and_write(f, out_f, t)
+        finally:
+            f.close()
+            out_f.close()
+    return run, None
+
+def bench_move_header_and_write(paths, options):
+    """moving 'moov' in front of 'mdat', to a file"""
+    path = paths['moov_last']
+    out_path = path + '.fstart'
+    def run():
+        f, out_f = open(path, 'rb'), open(out_path, 'wb')
+        try:
+            iso.move_header_and_write(f, out_f)
+        finally:
+            f.close()
+            out_f.close()
+    return run, None
+
+def bench_async_splitter(paths, options):
+    """Splitter fed with data, with a simulated latency per request"""
+    path = paths['moov_last']
+    t = _split_times(_load(path), 1)[0]
+    stats = {}
+    def run():
+        f = open(path, 'rb')
+        requests = [0, 0]
+        def read(offset, size):
+            time.sleep(options.latency)
+            requests[0] += 1
+            requests[1] += size
+            f.seek(offset)
+            return f.read(size)
+        try:
+            async.split_with(read, t)
+        finally:
+            f.close()
+        stats['round_trips'], stats['bytes_requested'] = requests
+    return run, stats
+
+BENCHMARKS = [(name[len('bench_'):], f) for name, f in
+              sorted(globals().items()) if name.startswith('bench_')]
+
+
+class _NullFile(object):
+    def write(self, data):
+        pass
+
+
+def _max_rss():
+    # in kilobytes (on Linux)
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _measure(bench, paths, options):
+    run, extra = bench(paths, options)
+    rss = _max_rss()
+    run()
+    if rss is not None:
+        rss = _max_rss() - rss
+    times = []
+    for i in xrange(options.repeat):
+        start = time.time()
+        run()
+        times.append(time.time() - start)
+    times.sort()
+    result = dict(best=times[0], median=times[len(times) // 2],
+                  repeat=options.repeat, peak_rss_kb=rss)
+    result.update(extra or {})
+    return result
+
+def measure(bench, paths, options):
+    """Run a benchmark, in a child process if possible.
+
+    @returns: the results of the benchmark
+    @rtype:   dict
+    """
+    if not hasattr(os, 'fork'):
+        return _measure(bench, paths, options)
+    r, w = os.pipe()
+    pid = os.fork()
+    if not pid:
+        status = 0
+        try:
+            try:
+                os.close(r)
+                result = _measure(bench, paths, options)
+            except Exception, e:
+                result = dict(error='%s: %s' % (e.__class__.__name__, e))
+                status = 1
+            os.write(w, json.dumps(result))
+        finally:
+            os._exit(status)
+    os.close(w)
+    data = []
+    while True:
+        chunk = os.read(r, 65536)
+        if not chunk:
+            break
+        data.append(chunk)
+    os.close(r)
+    os.waitpid(pid, 0)
+    return json.loads(''.join(data) or '{"error": "no results"}')
+
+def run_all(options, report=None):
+    """Run the benchmarks selected by the options.
+
+    @returns: results, ready to be stored as JSON
+    @rtype:   dict
+    """
+    directory = tempfile.mkdtemp(prefix='mp4seek-bench-')
+    try:
+        paths = make_files(directory, options.samples, options.tracks)
+        results = {}
+        for name, bench in BENCHMARKS:
+            if options.only and not [s for s in options.only if s in name]:
+                continue
+            results[name] = measure(bench, paths, options)
+            if report:
+                report(name, results[name])
+    finally:
+        shutil.rmtree(directory)
+    return dict(format=FORMAT, python=platform.python_version(),
+                platform=platform.platform(),
+                numpy=vector.numpy is not None,
+                params=dict(samples=options.samples, tracks=options.tracks,
+                            repeat=options.repeat, latency=options.latency),
+                benchmarks=results)
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Compare the best times of the benchmarks with a baseline.
+
+    @returns: (name, baseline time, time, ratio, regressed) of the
+              benchmarks found in both
+    @rtype:   list
+    """
+    compared = []
+    old = baseline.get('benchmarks', {})
+    for name, result in sorted(results['benchmarks'].items()):
+        if name not in old or 'best' not in result or 'best' not in old[name]:
+            continue
+        before, now = old[name]['best'], result['best']
+        ratio = now / max(before, 1e-9)
+        compared.append((name, before, now, ratio, ratio > 1 + tolerance))
+    return compared
+
+
+def _print_result(name, result):
+    if 'error' in result:
+        print '%-24s %s' % (name, result['error'])
+        return
+    rss = result['peak_rss_kb']
+    print '%-24s %9.4fs %9.4fs %10s' % (name, result['best'],
+                                        result['median'],
+                                        rss is not None and '%dkB' % rss or
+                                        '-')
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help='store the results (as JSON) in a file')
+    parser.add_option('-b', '--baseline', dest='baseline', default=None,
+                      help='compare the results with the ones stored in'
+                      ' a file')
+    parser.add_option('-t', '--tolerance', dest='tolerance', type='float',
+                      default=TOLERANCE,
+                      help='allowed slowdown relative to the baseline'
+                      ' (default: %default)')
+    parser.add_option('-n', '--samples', dest='samples', type='int',
+                      default=50000,
+                      help='number of samples per trak in the test files'
+                      ' (default: %default)')
+    parser.add_option('--tracks', dest='tracks', type='int', default=2,
+                      help='number of traks in the test files'
+                      ' (default: %default)')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int',
+                      default=5,
+                      help='number of timed runs of each benchmark'
+                      ' (default: %default)')
+    parser.add_option('--latency', dest='latency', type='float',
+                      default=0.005,
+                      help='simulated latency of the data requests of'
+                      ' the async benchmark, in seconds'
+                      ' (default: %default)')
+    options, args = parser.parse_args()
+    options.only = args
+
+    print '%-24s %10s %10s %10s' % ('benchmark', 'best', 'median', 'peak')
+    results = run_all(options, _print_result)
+
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump(results, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    failed = [name for name, r in results['benchmarks'].items()
+              if 'error' in r]
+    if options.baseline:
+        f = open(options.baseline)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        print
+        print '%-24s %10s %10s %7s' % ('benchmark', 'baseline', 'now',
+                                       'ratio')
+        for name, before, now, ratio, regressed in \
+                compare(results, baseline, options.tolerance):
+            print '%-24s %9.4fs %9.4fs %6.2fx%s' % (name, before, now, ratio,
+                                                    regressed and ' !' or '')
+            if regressed:
+                failed.append(name)
+
+    sys.exit(failed and 1 or 0)
+
+
+if __name__ == '__main__':
+    main()
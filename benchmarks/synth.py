@@ -0,0 +1,210 @@
+"""Generator of synthetic ISO files for the benchmarks.
+
+The files hold no real media, but their structure - the sample tables,
+the chunks interleaving and the top-level layout - is what a muxer
+would write: a video trak (with sync samples and composition offsets)
+followed by audio traks, their chunks interleaved in one 'mdat' atom.
+"""
+
+import struct
+import sys
+
+TIMESCALE = 1000
+
+# sample duration, in TIMESCALE units
+SAMPLE_DURATION = 40
+
+# bytes of media data written at once
+WRITE_SIZE = 1024 * 1024
+
+
+def box(type, payload):
+    return struct.pack('>L4s', 8 + len(payload), type) + payload
+
+def full_box(type, v, flags, payload):
+    return box(type, struct.pack('>L', (v & 0xff) << 24 | flags) + payload)
+
+def table(fmt, rows):
+    """Pack the rows of a sample table, with its entry count."""
+    flat = []
+    for row in rows:
+        flat.extend(row)
+    return struct.pack('>L%d%s' % (len(flat), fmt[0]), len(rows), *flat)
+
+def runs(values):
+    "Run-length encode values into [count, value] pairs."
+    ret = []
+    for v in values:
+        if ret and ret[-1][1] == v:
+            ret[-1][0] += 1
+        else:
+            ret.append([1, v])
+    return ret
+
+
+def sample_sizes(track, samples):
+    return [100 + (i * 7 + track * 13) % 50 for i in xrange(samples)]
+
+def sample_durations(samples, stts_run=0):
+    if not stts_run:
+        return [SAMPLE_DURATION] * samples
+    return [SAMPLE_DURATION + (i // stts_run) % 3 for i in xrange(samples)]
+
+def chunk_counts(samples, samples_per_chunk=5, chunk_run=0):
+    "Returns the number of samples in each chunk."
+    counts = []
+    left = samples
+    while left > 0:
+        n = samples_per_chunk
+        if chunk_run and (len(counts) // chunk_run) % 2:
+            n += 1
+        counts.append(min(n, left))
+        left -= n
+    return counts
+
+
+def make(path, tracks=2, samples=1000, moov_first=True, co64=False,
+         key_interval=25, samples_per_chunk=5, chunk_run=0, stts_run=0,
+         ctts=True):
+    """Write a synthetic file to path.
+
+    @param tracks: number of traks - the first one is the video trak
+    @type  tracks: int
+
+    @param samples: number of samples in each trak
+    @type  samples: int
+
+    @param moov_first: whether to place the 'moov' atom in front of the
+                       'mdat' atom
+    @type  moov_first: bool
+
+    @param co64: whether to use 'co64' chunk offset tables, 'stco' if
+                 False
+    @type  co64: bool
+
+    @param key_interval: number of samples between the sync samples of
+                         the video trak
+    @type  key_interval: int
+
+    @param samples_per_chunk: number of samples in the chunks
+    @type  samples_per_chunk: int
+
+    @param chunk_run: number of chunks after which the number of
+                      samples per chunk changes (by one, back and forth)
+                      - one 'stsc' entry per run, a single one if 0
+    @type  chunk_run: int
+
+    @param stts_run: number of samples after which the sample duration
+                     changes - one 'stts' entry per run, a single one
+                     if 0
+    @type  stts_run: int
+
+    @param ctts: whether to give the video trak composition offsets, a
+                 'ctts' entry for each sample
+    @type  ctts: bool
+
+    @returns: size of the written file
+    @rtype:   int
+    """
+    sizes = [sample_sizes(t, samples) for t in xrange(tracks)]
+    durations = sample_durations(samples, stts_run)
+    counts = chunk_counts(samples, samples_per_chunk, chunk_run)
+    data_size = sum([sum(s) for s in sizes])
+
+    ftyp = box('ftyp', 'isom' + struct.pack('>L', 512) + 'isomiso2mp41')
+    head = ftyp + box('free', '')
+    mdat_head = struct.pack('>L4s', 8 + data_size, 'mdat')
+
+    def build_moov(data_start):
+        offsets = [[] for t in xrange(tracks)]
+        pos = data_start
+        first = 0
+        for n in counts:
+            for t in xrange(tracks):
+                offsets[t].append(pos)
+                pos += sum(sizes[t][first:first + n])
+            first += n
+        return _moov(sizes, durations, counts, offsets, co64, key_interval,
+                     ctts)
+
+    if moov_first:
+        start = len(head) + len(build_moov(0)) + len(mdat_head)
+        moov = build_moov(start)
+        head += moov
+    else:
+        moov = build_moov(len(head) + len(mdat_head))
+
+    f = open(path, 'wb')
+    try:
+        f.write(head + mdat_head)
+        _write_data(f, sizes, counts)
+        if not moov_first:
+            f.write(moov)
+        return f.tell()
+    finally:
+        f.close()
+
+def _write_data(f, sizes, counts):
+    buf, buffered = [], 0
+    first = 0
+    for n in counts:
+        for t, tsizes in enumerate(sizes):
+            size = sum(tsizes[first:first + n])
+            buf.append(chr(65 + t % 26) * size)
+            buffered += size
+        first += n
+        if buffered >= WRITE_SIZE:
+            f.write(''.join(buf))
+            buf, buffered = [], 0
+    f.write(''.join(buf))
+
+def _moov(sizes, durations, counts, offsets, co64, key_interval, ctts):
+    samples = len(durations)
+    duration = sum(durations)
+    stts_rows = runs(durations)
+    stsc_rows = []
+    chunk = 1
+    for n, count in runs(counts):
+        stsc_rows.append((chunk, count, 1))
+        chunk += n
+
+    mvhd = full_box('mvhd', 0, 0, struct.pack('>4L', 0, 0, TIMESCALE,
+                                              duration) + '\0' * 80)
+    traks = []
+    for t, tsizes in enumerate(sizes):
+        video = t == 0
+        tkhd = full_box('tkhd', 0, 0, struct.pack('>5L', 0, 0, t + 1, 0,
+                                                  duration) + '\0' * 60)
+        mdhd = full_box('mdhd', 0, 0, struct.pack('>4L', 0, 0, TIMESCALE,
+                                                  duration) + '\0' * 4)
+        hdlr = full_box('hdlr', 0, 0, '\0' * 4 + (video and 'vide' or 'soun')
+                        + '\0' * 13)
+        kids = [full_box('stsd', 0, 0, struct.pack('>L', 0)),
+                full_box('stts', 0, 0, table('LL', stts_rows))]
+        if video and ctts:
+            kids.append(full_box('ctts', 0, 0, table(
+                'LL', [(1, 2 * SAMPLE_DURATION * (i % 2))
+                       for i in xrange(samples)])))
+        if video:
+            kids.append(full_box('stss', 0, 0, table(
+                'L', [(i + 1,) for i in xrange(0, samples, key_interval)])))
+        kids.append(full_box('stsz', 0, 0, struct.pack('>L', 0) +
+                             table('L', [(s,) for s in tsizes])))
+        kids.append(full_box('stsc', 0, 0, table('LLL', stsc_rows)))
+        if co64:
+            kids.append(full_box('co64', 0, 0, table(
+                'Q', [(o,) for o in offsets[t]])))
+        else:
+            kids.append(full_box('stco', 0, 0, table(
+                'L', [(o,) for o in offsets[t]])))
+        stbl = box('stbl', ''.join(kids))
+        minf = box('minf', full_box(video and 'vmhd' or 'smhd', 0, 1,
+                                    '\0' * 8) + stbl)
+        mdia = box('mdia', mdhd + hdlr + minf)
+        traks.append(box('trak', tkhd + mdia))
+    return box('moov', mvhd + ''.join(traks))
+
+
+if __name__ == '__main__':
+    make(sys.argv[1], samples=int(sys.argv[2]),
+         moov_first=(sys.argv[3:4] != ['0']))
@@ -2,28 +2,91 @@ from cStringIO import StringIO
 import struct
 
 import iso
+import observe
+import sidecar
 
 class Splitter(object):
-    """Helper class for async/data-driven splitting."""
+    """Helper class for async/data-driven splitting.
+
+    Files with the 'moov' atom placed after the media data are handled
+    too: the 'mdat' atoms are skipped over (by their sizes) and the
+    'moov' atom is requested directly. The split output then needs to
+    be completed with a limited range of the original data, see
+    L{result_range}.
+    """
 
     MIN_HEAD_CHUNK = 16
 
-    def __init__(self, t):
+    # size of the data requested up front, hopefully covering the
+    # headers of all the atoms preceding 'mdat' (and 'moov' itself)
+    READAHEAD = 64 * 1024
+
+    def __init__(self, t, path=None, readahead=None, end_t=None):
         """
         @param t: split point, in seconds - nearest sync point will be used
         @type  t: float
+
+        @param path: path of the split file, if known - used to look up
+                     its seek index (see L{sidecar}), which saves
+                     walking the atoms and parsing the header
+        @type  path: str
+
+        @param readahead: minimum size of the data requests made before
+                          the positions of 'moov' and 'mdat' are known,
+                          L{READAHEAD} if None
+        @type  readahead: int
+
+        @param end_t: end of the clip, in seconds - up to the end of the
+                      file if None
+        @type  end_t: float
+
+        @raise ValueError: if end_t doesn't follow t
         """
+        # rather than after fetching the headers
+        iso.check_clip(t, end_t)
         self.t = t
+        self.end_t = end_t
         self.data_cb = None
+        self.readahead = readahead
+        if readahead is None:
+            self.readahead = self.READAHEAD
+
+        # all the data received so far
+        self._file = SparseFile()
+        self._requested = 0
+        self._req_offset = 0
+        self._eof = None
         self._offset = 0
 
         self._inc_offset = 0
         self._moov_found = False
+        self._mdat_found = False
+        # the 'moov' atom, if placed after 'mdat'
+        self._moov = None
+        # the 'moov' atom, if placed before 'mdat'
+        self._moov_head = None
 
         self._all_found = False
 
+        # number and total size of the data requests made so far
+        self.round_trips = 0
+        self.bytes_requested = 0
+
         self._out_f = None
         self._out_offset = None
+        self._out_end = None
+
+        self._index = None
+        if path is not None:
+            self._index = sidecar.load_path(path)
+        if self._index is not None:
+            # the layout is known already - only the head (and 'moov',
+            # for raw copies of its unparsed children) is needed
+            self._all_found = True
+            self._inc_offset = self._index.mdat_offset()
+            if not self._index.moov_before_mdat():
+                offset, end = self._index.moov_range()
+                self._moov = AtomStub(end - offset, 'moov', offset)
 
     def start(self, data_cb):
         """Prepare L{Splitter} object.
@@ -45,10 +108,21 @@ class Splitter(object):
         @param data: buffer of data, as requested in call to data_cb
         @type  data: str
         """
-        # not checking if the data size is what we actually requested... FIXME?
         size, offset = self._handle_feed(data)
         self.data_cb(size, offset)
 
+    def requests(self):
+        """Generator version of the L{start}/L{feed} protocol.
+
+        Yields the (size, offset) data requests, each to be answered by
+        sending the requested data into the generator. Once the
+        generator is exhausted, L{result_range} is available.
+        """
+        size, offset = self.next_chunk()
+        while size:
+            data = yield size, offset
+            size, offset = self._handle_feed(data)
+
     def result(self):
         """Returns results of splitting.
 
@@ -56,38 +130,292 @@ class Splitter(object):
         copying data for the original file should start
         @rtype:   StringIO, int
         """
+        out_f, start, end = self.result_range()
+        return out_f, start
+
+    def result_range(self):
+        """Returns results of splitting.
+
+        @returns: rewritten file header and the range of the original
+                  file data (start, end) to follow it, end being None
+                  for the end of the file
+        @rtype:   StringIO, int, int or None
+        """
         if self._out_f is None:
             self._build_result()
-        return self._out_f, self._out_offset
+        return self._out_f, self._out_offset, self._out_end
 
     def _handle_feed(self, data):
-        if self._all_found:
-            self.in_f = StringIO(data)
-            return 0, 0
-
-        a, next = get_stub(self._offset, data)
-        if a.type == 'mdat':
-            if not self._moov_found:
-                raise iso.FormatError('No "moov" before "mdat" found - cannot'
+        self._file.add(self._req_offset, data)
+        if len(data) < self._requested:
+            self._eof = self._req_offset + len(data)
+
+        if not self._all_found:
+            self._find_atoms()
+
+        size, offset = self.next_chunk()
+        if not size:
+            # everything past the needed data would only confuse iso
+            self._file.truncate(self._needed()[-1][1])
+            self.in_f = self._file
+        return size, offset
+
+    def _find_atoms(self):
+        # walk the atom headers contained in the data received so far
+        while not self._all_found:
+            stub = self._file.peek(self._offset, self.MIN_HEAD_CHUNK)
+            if len(stub) < 8 or (len(stub) < self.MIN_HEAD_CHUNK and
+                                 struct.unpack('>L', stub[:4])[0] == 1):
+                return
+
+            a, next = get_stub(self._offset, stub)
+            if a.type == 'mdat':
+                if not self._mdat_found:
+                    self._inc_offset = a.offset
+                    self._mdat_found = True
+                self._all_found = self._moov_found
+            elif a.type == 'moov':
+                self._moov_found = True
+                if not self._mdat_found:
+                    self._moov_head = a
+                if self._mdat_found:
+                    self._moov = a
+                    self._all_found = True
+
+            self._offset = next
+            if next is None and not self._all_found:
+                raise iso.FormatError('Not all needed atoms found - cannot'
                                       ' seek')
-            self._all_found = True
-        elif a.type == 'moov':
-            self._moov_found = True
 
-        self._inc_offset = a.offset
-        self._offset = next
-        if next is None and not self._all_found:
-            raise iso.FormatError('Not all needed atoms found - cannot seek')
-
-        return self.next_chunk()
+    def _needed(self):
+        # ranges of data needed to split the file, once all found
+        ranges = [(0, self._inc_offset + self.MIN_HEAD_CHUNK)]
+        if self._moov is not None:
+            ranges.append((self._moov.offset,
+                           self._moov.offset + self._moov.size))
+        return ranges
+
+    def _request(self, offset, end):
+        self._req_offset, self._requested = offset, end - offset
+        self.round_trips += 1
+        self.bytes_requested += self._requested
+        observer = observe.installed()
+        if observer is not None:
+            observer.request(self._requested, offset)
+        return self._requested, offset
 
     def _build_result(self):
-        self._out_f, self._out_offset = iso.split(self.in_f, self.t, out_f=StringIO())
+        self._out_f, self._out_offset, self._out_end = \
+            iso.split_range(self.in_f, self.t, out_f=StringIO(),
+                            index=self._index, end_t=self.end_t)
 
     def next_chunk(self):
-        if self._all_found:
-            return self._inc_offset + self.MIN_HEAD_CHUNK, 0
-        return self.MIN_HEAD_CHUNK, self._offset
+        # only ever asking for the data that wasn't received yet
+        if not self._all_found:
+            have = self._file.covered(self._offset)
+            if self._eof is not None and have >= self._eof:
+                raise iso.FormatError('Not all needed atoms found - cannot'
+                                      ' seek')
+            if self._moov_head is not None:
+                # the rest of 'moov' and the header following it, in one
+                # go and nothing more - it's most likely 'mdat'
+                moov_have = self._file.covered(self._moov_head.offset)
+                if moov_have < self._offset:
+                    return self._request(*self._file.missing(
+                            moov_have, self._offset + self.MIN_HEAD_CHUNK)[0])
+            return self._request(*self._file.missing(
+                    have, max(self._offset + self.MIN_HEAD_CHUNK,
+                              have + self.readahead))[0])
+
+        for start, end in self._needed():
+            missing = self._file.missing(start, end)
+            if not missing:
+                continue
+            have, end = missing[0]
+            if self._eof is not None and have >= self._eof:
+                if start == 0:
+                    # all there is, up to the 'mdat' data
+                    continue
+                raise iso.FormatError('Not enough data: "moov" truncated')
+            return self._request(have, end)
+        return 0, 0
+
+
+class SparseFile(object):
+    """Read-only file-like object holding some ranges of data of a
+    file - what L{iso} needs to read when splitting it."""
+
+    def __init__(self):
+        # sorted, non-adjacent (offset, data) pairs
+        self._ranges = []
+        self._pos = 0
+        self.size = 0
+
+    def add(self, offset, data):
+        """Store data found at the given offset of the file."""
+        end = offset + len(data)
+        ranges = []
+        for roffset, rdata in self._ranges:
+            rend = roffset + len(rdata)
+            if rend < offset or roffset > end:
+                ranges.append((roffset, rdata))
+                continue
+            if roffset < offset:
+                data = rdata[:offset - roffset] + data
+                offset = roffset
+            if rend > end:
+                data = data + rdata[end - roffset:]
+                end = rend
+        ranges.append((offset, data))
+        ranges.sort()
+        self._ranges = ranges
+        self.size = max(self.size, end)
+
+    def covered(self, offset):
+        """Returns the end of the data available from offset on, offset
+        itself if there is none."""
+        for roffset, rdata in self._ranges:
+            if roffset <= offset < roffset + len(rdata):
+                return min(roffset + len(rdata), self.size)
+        return offset
+
+    def missing(self, start, end):
+        """Returns the (start, end) sub-ranges of [start, end) with no
+        data available, in order."""
+        missing = []
+        for roffset, rdata in self._ranges:
+            rend = roffset + len(rdata)
+            if rend <= start:
+                continue
+            if roffset >= end:
+                break
+            if roffset > start:
+                missing.append((start, roffset))
+            start = rend
+        if start < end:
+            missing.append((start, end))
+        return missing
+
+    def peek(self, offset, size):
+        for roffset, rdata in self._ranges:
+            if roffset <= offset < roffset + len(rdata):
+                size = max(min(size, self.size - offset), 0)
+                return rdata[offset - roffset:offset - roffset + size]
+        return ''
+
+    def truncate(self, size):
+        self.size = min(self.size, size)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.size
+        self._pos = offset
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size
+        data = self.peek(self._pos, size)
+        self._pos += len(data)
+        return data
+
+
+def split_with(read, t, path=None, end_t=None):
+    """Split a file using a blocking reader.
+
+    @param read: function reading size bytes at offset
+    @type  read: (offset, size) -> str
+
+    @returns: the same as L{Splitter.result_range}
+    """
+    s = Splitter(t, path, end_t=end_t)
+    steps = s.requests()
+    data = None
+    while True:
+        try:
+            size, offset = steps.send(data)
+        except StopIteration:
+            return s.result_range()
+        data = read(offset, size)
+
+def split_deferred(read, t, path=None, timeout=None, clock=None,
+                   end_t=None):
+    """Split a file using an asynchronous reader, with Twisted.
+
+    Any number of splits can run concurrently in one reactor thread.
+    The returned Deferred can be cancelled, which cancels the pending
+    read too.
+
+    @param read: function reading size bytes at offset
+    @type  read: (offset, size) -> Deferred (or str)
+
+    @param timeout: number of seconds after which the split fails with
+                    L{twisted.internet.defer.TimeoutError}
+    @type  timeout: float
+
+    @param clock: provider of callLater, the reactor if None
+    @type  clock: L{twisted.internet.interfaces.IReactorTime}
+
+    @returns: Deferred firing with the same as L{Splitter.result_range}
+    @rtype:   L{twisted.internet.defer.Deferred}
+    """
+    from twisted.internet import defer
+
+    s = Splitter(t, path, end_t=end_t)
+    steps = s.requests()
+    pending = [None]
+
+    def cancel(d):
+        steps.close()
+        if pending[0] is not None:
+            pending[0].cancel()
+
+    result = defer.Deferred(cancel)
+
+    def failed(failure):
+        pending[0] = None
+        if not result.called:
+            result.errback(failure)
+
+    def step(data):
+        pending[0] = None
+        if result.called:
+            return
+        try:
+            try:
+                size, offset = steps.send(data)
+            except StopIteration:
+                result.callback(s.result_range())
+                return
+        except Exception:
+            result.errback()
+            return
+        d = pending[0] = defer.maybeDeferred(read, offset, size)
+        d.addCallbacks(step, failed)
+
+    if timeout is not None:
+        if clock is None:
+            from twisted.internet import reactor as clock
+        timed_out = []
+        def expire():
+            timed_out.append(True)
+            result.cancel()
+        call = clock.callLater(timeout, expire)
+        def finished(r):
+            if call.active():
+                call.cancel()
+            if timed_out:
+                r.trap(defer.CancelledError)
+                raise defer.TimeoutError(timeout, 'Splitting timed out')
+            return r
+        result.addBoth(finished)
+
+    step(None)
+    return result
 
 
 class AtomStub(object):
@@ -139,13 +467,16 @@ def test(f, t):
         s.feed(f.read(req[0]))
 
     # get the results
-    header_f, new_offset = s.result()
+    header_f, new_offset, end = s.result_range()
 
     # we have all we need to write the new file
     header_f.seek(0)
     out_f.write(header_f.read())
     f.seek(new_offset)
-    out_f.write(f.read())
+    if end is None:
+        out_f.write(f.read())
+    else:
+        out_f.write(f.read(end - new_offset))
 
 
 if __name__ == '__main__':
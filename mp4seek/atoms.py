@@ -1,5 +1,10 @@
+import copy
+import mmap
+import os
 import struct
 
+import transfer
+
 BUFFER_SIZE = 16*1024
 
 
@@ -47,12 +52,13 @@ class Atom(object):
 
     def write(self, fobj):
         # print '[ a] writing:', self
-        self.seek_to_start()
-        remaining = self.size
-        while remaining > 0:
-            buf = self.read_bytes(min(remaining, BUFFER_SIZE))
-            remaining -= len(buf)
-            fobj.write(buf)
+        transfer.copy_range(self.f, fobj, self.offset, self.size)
+
+    def bound(self, fobj):
+        """Returns a copy of the atom reading its data from fobj."""
+        a = copy.copy(self)
+        a.f = fobj
+        return a
 
     def itype(self):
         return struct.unpack('>L', self.type)[0]
@@ -86,9 +92,18 @@ class ContainerAtom(Atom):
 
     def get_children_dict(self):
         if self._children_dict is None:
-            self._children_dict = atoms_dict(self.read_children())
+            self._children_dict = atoms_dict(self.get_children())
         return self._children_dict
 
+    def bound(self, fobj):
+        a = Atom.bound(self, fobj)
+        if self._children is not None:
+            a._children = [ca.bound(fobj) for ca in self._children]
+        if self._children_dict is not None:
+            a._children_dict = dict([(k, [ca.bound(fobj) for ca in v])
+                                     for k, v in self._children_dict.items()])
+        return a
+
     @classmethod
     def from_atom(cls, a):
         return cls(a.size, a.type, a.offset, a.f, real_size=a.real_size)
@@ -122,6 +137,71 @@ class FullAtom(Atom):
                  self.v, self.flags, self.real_size))
 
 
+class MappedFile(object):
+    """Read-only, file-like object over a memory-mapped file.
+
+    Atoms and boxes read through a L{MappedFile} don't issue any
+    syscalls while parsing: fixed-size fields are unpacked directly
+    from the mapping and tables are decoded from views of the mapped
+    pages, see L{read_view}.
+    """
+
+    def __init__(self, fobj):
+        self._fobj = fobj
+        self.name = getattr(fobj, 'name', None)
+        self._size = os.fstat(fobj.fileno()).st_size
+        if self._size:
+            self._map = mmap.mmap(fobj.fileno(), self._size,
+                                  access=mmap.ACCESS_READ)
+        else:
+            self._map = ''
+        self._pos = 0
+
+    def fileno(self):
+        return self._fobj.fileno()
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self._size
+        self._pos = max(offset, 0)
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        pos = self._pos
+        if size < 0:
+            size = self._size - pos
+        data = self._map[pos:pos + size]
+        self._pos = pos + len(data)
+        return data
+
+    def read_view(self, size):
+        """Like read, but returns a buffer over the mapped data instead
+        of a copy."""
+        pos = self._pos
+        size = max(min(size, self._size - pos), 0)
+        self._pos = pos + size
+        return buffer(self._map, pos, size)
+
+    def unpack(self, fmt, size):
+        """Unpack size bytes at the current position with the given
+        L{struct} format."""
+        if self._pos + size > self._size:
+            raise RuntimeError('Not enough data: requested %d, read %d' %
+                               (size, max(self._size - self._pos, 0)))
+        values = struct.unpack_from(fmt, self._map, self._pos)
+        self._pos += size
+        return values
+
+    def close(self):
+        if self._size:
+            self._map.close()
+        self._fobj.close()
+
+
 def read_bytes(fobj, bytes):
     data = fobj.read(bytes)
     if len(data) != bytes:
@@ -129,10 +209,24 @@ def read_bytes(fobj, bytes):
                            (bytes, len(data)))
     return data
 
+def read_view(fobj, bytes):
+    "Returns a buffer (or string) with the next bytes of the file."
+    if isinstance(fobj, MappedFile):
+        data = fobj.read_view(bytes)
+        if len(data) != bytes:
+            raise RuntimeError('Not enough data: requested %d, read %d' %
+                               (bytes, len(data)))
+        return data
+    return read_bytes(fobj, bytes)
+
 def read_ulong(fobj):
+    if isinstance(fobj, MappedFile):
+        return fobj.unpack('>L', 4)[0]
     return struct.unpack('>L', read_bytes(fobj, 4))[0]
 
 def read_ulonglong(fobj):
+    if isinstance(fobj, MappedFile):
+        return fobj.unpack('>Q', 8)[0]
     return struct.unpack('>Q', read_bytes(fobj, 8))[0]
 
 def read_fcc(fobj):
@@ -141,8 +235,12 @@ def read_fcc(fobj):
 
 def read_atom(fobj):
     pos = fobj.tell()
-    size = real_size = read_ulong(fobj)
-    type = read_fcc(fobj)
+    if isinstance(fobj, MappedFile):
+        size, type = fobj.unpack('>L4s', 8)
+        real_size = size
+    else:
+        size = real_size = read_ulong(fobj)
+        type = read_fcc(fobj)
 
     if size == 1:
         size = read_ulonglong(fobj)
@@ -0,0 +1,173 @@
+"""In-process cache of parsed 'moov' trees.
+
+Once installed with L{install}, the cache is consulted by
+L{iso.load_iso_file} (and so by L{iso.split} and friends) before
+parsing a file. Entries are keyed by the file path and its identity
+(size, mtime, inode), so modified files are parsed again, and evicted
+in least-recently-used order to keep the estimated memory used by the
+parsed sample tables within a budget.
+
+The cached trees are only ever used read-only - cutting works on
+copies of the boxes - so they can be shared between requests.
+"""
+
+from array import array
+import os
+import threading
+
+import atoms
+import iso
+import sidecar
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# rough per-object overheads, used when estimating the entry sizes
+_BOX_OVERHEAD = 512
+_LIST_ITEM_SIZE = 32
+
+
+def file_key(fobj):
+    """Returns the cache key of an open file, or None if fobj is not
+    backed by a real file."""
+    path = getattr(fobj, 'name', None)
+    if not isinstance(path, basestring):
+        return None
+    identity = sidecar.file_identity(fobj)
+    if identity is None:
+        return None
+    return os.path.abspath(path), identity
+
+def _table_size(t):
+    if isinstance(t, array):
+        return len(t) * t.itemsize
+    if isinstance(t, iso.Table):
+        return sum([_table_size(c) for c in t.columns])
+    return len(t) * _LIST_ITEM_SIZE
+
+def estimate_size(v):
+    """Estimate the memory used by a parsed box tree, including the
+    lookup indexes that may get built for its tables."""
+    if isinstance(v, iso.Box):
+        size = _BOX_OVERHEAD
+        for k in getattr(v, '_fields', ()):
+            size += estimate_size(v.get_raw(k))
+        if isinstance(v, (iso.stts, iso.ctts, iso.stsc)):
+            # two cumulative 64-bit columns at most
+            size += (len(v.table) + 1) * 16
+        return size
+    if isinstance(v, atoms.Atom):
+        # not parsed yet (see iso.lazybox) - assume it will be
+        return _BOX_OVERHEAD + v.size
+    if isinstance(v, (array, iso.Table)):
+        return _table_size(v)
+    if isinstance(v, list):
+        return sum([estimate_size(elt) for elt in v])
+    return 0
+
+
+def _load_tables(amoov):
+    # parsed (and indexed) up front, so that all the copies handed out
+    # share them instead of loading their own
+    for atrak in amoov.trak:
+        stbl = atrak.mdia.minf.stbl
+        for k in stbl._fields:
+            getattr(stbl, k)
+        for abox in (stbl.stts, stbl.ctts, stbl.stsc):
+            if abox is not None:
+                abox.get_index()
+    # memoized, and kept by the bound copies
+    amoov.get_size()
+
+
+class MoovCache(object):
+    """LRU cache of parsed files, limited by the estimated size of the
+    cached data."""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = {}
+        # keys of the entries, least recently used first (no OrderedDict
+        # before python 2.7 - and there are few entries anyway)
+        self._order = []
+        self._lock = threading.Lock()
+
+    def get(self, key, fobj):
+        """Returns the cached structure of the file, bound to fobj.
+
+        @returns: the same as L{iso.load_iso_file}, or None if there is
+                  no entry for key
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._order.remove(key)
+            self._order.append(key)
+            self.hits += 1
+        finally:
+            self._lock.release()
+        (aftyp, amoov, alist, syncs), _size = entry
+        return (aftyp.bound(fobj), amoov.bound(fobj),
+                [a.bound(fobj) for a in alist], syncs)
+
+    def put(self, key, aftyp, amoov, alist, syncs):
+        _load_tables(amoov)
+        amoov = amoov.bound(None)
+        value = (aftyp.bound(None), amoov, [a.bound(None) for a in alist],
+                 syncs)
+        size = (estimate_size(amoov) + len(alist) * _BOX_OVERHEAD +
+                estimate_size(syncs.tables))
+        if size > self.max_bytes:
+            return
+
+        self._lock.acquire()
+        try:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+                self._order.remove(key)
+            self._entries[key] = (value, size)
+            self._order.append(key)
+            self.size += size
+            while self.size > self.max_bytes:
+                _value, esize = self._entries.pop(self._order.pop(0))
+                self.size -= esize
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            del self._order[:]
+            self.size = 0
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """Returns a dictionary with the cache counters."""
+        return dict(entries=len(self._entries), size=self.size,
+                    max_bytes=self.max_bytes, hits=self.hits,
+                    misses=self.misses, evictions=self.evictions)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_installed = None
+
+def install(moov_cache):
+    """Make L{iso} use the given L{MoovCache} (or stop using any, if
+    None)."""
+    global _installed
+    _installed = moov_cache
+
+def installed():
+    return _installed
@@ -0,0 +1,716 @@
+"""Fragmented MP4 output.
+
+L{FragmentedStream} serves a (progressive) file as a fragmented one:
+an init segment - a new 'ftyp' and the 'moov' atom with empty sample
+tables and an 'mvex' atom - followed by 'moof' + 'mdat' fragments,
+each of them starting at a sync point. The fragments are built from the
+sample tables of the original file one at a time, as the stream is
+iterated, so that the first of them can be sent out right after the
+(small) init segment:
+
+    def app(environ, start_response):
+        s = FragmentedStream(open(path, 'rb'), t)
+        start_response('200 OK', [('Content-Type', 'video/mp4')])
+        return s
+
+The total length of the output is not known up front.
+
+Files that are fragmented already can be split too (see
+L{split_fragments}, used by L{iso.split_range} for them): the output
+starts with the fragment holding the sync sample nearest to the split
+point, found with the 'mfra' random access index at the end of the
+file or, when there is none, by walking the 'moof' atoms once.
+"""
+
+from bisect import bisect_left, bisect_right
+from cStringIO import StringIO
+from itertools import chain, izip, repeat
+from math import ceil
+import struct
+
+import atoms
+import iso
+from iso import read_fcc, read_ulong
+import transfer
+
+CHUNK_SIZE = 64 * 1024
+
+# duration of the fragments (in seconds) of files with no sync sample
+# tables at all, in which every sample is a sync point
+FRAGMENT_DURATION = 1.0
+
+FTYP_BRANDS = ('iso5', 'iso6', 'mp41')
+
+# trun flags
+DATA_OFFSET = 0x000001
+SAMPLE_DURATION = 0x000100
+SAMPLE_SIZE = 0x000200
+SAMPLE_FLAGS = 0x000400
+SAMPLE_CTO = 0x000800
+
+FIRST_SAMPLE_FLAGS = 0x000004
+
+# tfhd flags
+BASE_DATA_OFFSET = 0x000001
+SAMPLE_DESCRIPTION_INDEX = 0x000002
+DEFAULT_SAMPLE_DURATION = 0x000008
+DEFAULT_SAMPLE_SIZE = 0x000010
+DEFAULT_SAMPLE_FLAGS = 0x000020
+DEFAULT_BASE_IS_MOOF = 0x020000
+
+# sample flags: depends on no other samples / a non-sync sample
+SYNC_SAMPLE_FLAGS = 0x02000000
+NON_SYNC_SAMPLE_FLAGS = 0x01010000
+SAMPLE_IS_NON_SYNC = 0x00010000
+
+
+def _box(type, payload):
+    size = len(payload) + 8
+    if size > 0xffffffffL:
+        return struct.pack('>L4sQ', 1, type, size + 8) + payload
+    return struct.pack('>L4s', size, type) + payload
+
+def _full_box(type, v, flags, payload):
+    return _box(type, struct.pack('>L', (v & 0xff) << 24 |
+                                  (flags & 0xffffff)) + payload)
+
+def _track_id(atrak):
+    a = atrak.tkhd._atom
+    a.seek_to_start()
+    a.skip(a.head_size_ext() + (a.v == 1 and 16 or 8))
+    return read_ulong(a.f)
+
+
+def make_ftyp():
+    brands = FTYP_BRANDS
+    return _box('ftyp', brands[0] + struct.pack('>L', 0) + ''.join(brands))
+
+def make_mvex(track_ids, duration):
+    """
+    @param duration: duration of the whole fragmented movie, in the
+                     movie timescale
+    """
+    payload = _full_box('mehd', 1, 0, struct.pack('>Q', duration))
+    for track_id in track_ids:
+        payload += _full_box('trex', 0, 0,
+                             struct.pack('>5L', track_id, 1, 0, 0, 0))
+    return _box('mvex', payload)
+
+def _empty_trak(atrak):
+    stbl = atrak.mdia.minf.stbl
+    attribs = dict(stts=stbl.stts.copy(table=stbl.stts.table[:0]),
+                   stsc=stbl.stsc.copy(table=stbl.stsc.table[:0]),
+                   stss=None, ctts=None)
+    stco64 = stbl.stco or stbl.co64
+    attribs[stbl.stco and 'stco' or 'co64'] = \
+        stco64.copy(table=stco64.table[:0])
+    if stbl.stsz:
+        attribs['stsz'] = stbl.stsz.copy(sample_size=0,
+                                         table=stbl.stsz.table[:0])
+    else:
+        attribs['stz2'] = stbl.stz2.copy(table=stbl.stz2.table[:0])
+
+    new_minf = atrak.mdia.minf.copy(stbl=stbl.copy(**attribs))
+    new_mdia = atrak.mdia.copy(mdhd=atrak.mdia.mdhd.copy(duration=0),
+                               minf=new_minf)
+    return atrak.copy(tkhd=atrak.tkhd.copy(duration=0), mdia=new_mdia)
+
+def make_init_moov(amoov, duration):
+    """Returns the serialized 'moov' atom of the init segment: amoov
+    with no samples in its tables, extended with an 'mvex' atom.
+
+    @param duration: duration of the fragmented movie, in the movie
+                     timescale
+    """
+    traks = amoov.trak
+    new_moov = amoov.copy(mvhd=amoov.mvhd.copy(duration=0),
+                          trak=map(_empty_trak, traks))
+    s = StringIO()
+    new_moov.write(s)
+    data = s.getvalue()
+
+    # the boxes don't know about 'mvex' - appended to the written atom
+    mvex = make_mvex(map(_track_id, traks), duration)
+    size, = struct.unpack('>L', data[:4])
+    if size == 1:
+        size, = struct.unpack('>Q', data[8:16])
+        return (data[:8] + struct.pack('>Q', size + len(mvex)) + data[16:] +
+                mvex)
+    return struct.pack('>L', size + len(mvex)) + data[4:] + mvex
+
+
+def _run_values(table, starts, sample):
+    # per-sample values of a run-length 'stts'/'ctts' table, from the
+    # 1-based sample number on
+    counts, values = table.columns
+    i = max(bisect_right(starts, sample) - 1, 0)
+    skip = sample - starts[i]
+    for j in xrange(i, len(counts)):
+        for v in repeat(values[j], counts[j] - skip):
+            yield v
+        skip = 0
+
+def _sample_offsets(stbl, sample, size):
+    # file offsets of the samples, from the 1-based sample number on
+    stsc = stbl.stsc
+    firsts, per_chunks = stsc.table.columns[:2]
+    if not len(firsts):
+        return
+    index = stsc.get_index()
+    chunks = (stbl.stco or stbl.co64).table
+    i = max(bisect_right(index, sample, 1) - 1, 0)
+    chunk = iso.find_chunknum_stsc(stsc.table, sample, index)
+    s = index[i] + (chunk - firsts[i]) * per_chunks[i]
+    n = len(firsts)
+    while chunk <= len(chunks):
+        while i + 1 < n and firsts[i + 1] <= chunk:
+            i += 1
+        offset = chunks[chunk - 1]
+        end = s + per_chunks[i]
+        while s < sample:
+            offset += size(s)
+            s += 1
+        while s < end:
+            yield offset
+            offset += size(s)
+            s += 1
+        chunk += 1
+
+def _samples(atrak, sample):
+    """Yields (decode time, duration, size, sync, composition offset,
+    file offset) of the samples of atrak, from the 1-based sample
+    number on."""
+    stbl = atrak.mdia.minf.stbl
+    stts_index = stbl.stts.get_index()
+    total = stts_index[0][-1] - 1
+
+    stsz2 = stbl.stsz or stbl.stz2
+    sample_size = getattr(stsz2, 'sample_size', 0)
+    if sample_size:
+        size = lambda s: sample_size
+    else:
+        sizes = stsz2.table
+        size = lambda s: sizes[s - 1]
+
+    ctos = repeat(0)
+    if stbl.ctts:
+        ctos = chain(_run_values(stbl.ctts.table, stbl.ctts.get_index()[0],
+                                 sample), ctos)
+
+    syncs = None
+    if stbl.stss:
+        syncs = stbl.stss.table
+        j = bisect_left(syncs, sample)
+
+    dts = iso.find_mediatime_stts(stbl.stts.table, sample, stts_index)
+    for s, duration, cto, offset in izip(
+        xrange(sample, total + 1),
+        _run_values(stbl.stts.table, stts_index[0], sample), ctos,
+        _sample_offsets(stbl, sample, size)):
+        sync = True
+        if syncs is not None:
+            sync = j < len(syncs) and syncs[j] == s
+            if sync:
+                j += 1
+        yield dts, duration, size(s), sync, cto, offset
+        dts += duration
+
+
+class _Track(object):
+    def __init__(self, atrak, t):
+        stbl = atrak.mdia.minf.stbl
+        self.track_id = _track_id(atrak)
+        self.timescale = atrak.mdia.mdhd.timescale
+        self.cto_version = None
+        if stbl.ctts:
+            self.cto_version = stbl.ctts._atom.v
+
+        mt = int(round(t * self.timescale))
+        sample = iso.find_samplenum_stts(stbl.stts.table, mt,
+                                         stbl.stts.get_index())
+        # decode times in the output start from 0
+        self.base_time = iso.find_mediatime_stts(stbl.stts.table, sample,
+                                                 stbl.stts.get_index())
+        self._samples = _samples(atrak, sample)
+        self._next = None
+
+    def take(self, t):
+        """Returns the samples decoded before time t (in seconds, None
+        for all the remaining samples)."""
+        mt = None
+        if t is not None:
+            mt = int(round(t * self.timescale))
+        taken = []
+        s = self._next or next(self._samples, None)
+        while s is not None and (mt is None or s[0] < mt):
+            taken.append(s)
+            s = next(self._samples, None)
+        self._next = s
+        return taken
+
+
+def fragment_times(amoov, t, syncs=None, min_duration=None):
+    """Returns the start times (in seconds) of the fragments, the first
+    one being the sync point nearest t.
+
+    @param syncs: sync points of amoov
+    @type  syncs: L{iso.SyncIndex}
+
+    @param min_duration: minimum duration of the fragments, in seconds
+                         - every sync point starts a new fragment if None
+    @type  min_duration: float
+    """
+    if syncs is None:
+        syncs = amoov.get_sync_index()
+    start = iso.find_nearest_syncpoint(amoov, t, syncs)
+    if syncs.reference is not None:
+        points = syncs.points()
+    else:
+        duration = amoov.mvhd.duration / float(amoov.mvhd.timescale)
+        step = min_duration or FRAGMENT_DURATION
+        points = [start + i * step
+                  for i in xrange(int(ceil((duration - start) / step)))]
+    times = [start]
+    for ss in points:
+        if ss > times[-1] and ss - times[-1] >= (min_duration or 0):
+            times.append(ss)
+    return times
+
+def make_fragment(sequence, parts):
+    """Build a fragment out of the samples of the tracks.
+
+    @param sequence: sequence number of the fragment
+    @type  sequence: int
+
+    @param parts: (track, samples) pairs - non-empty lists of samples,
+                  as returned by L{_Track.take}
+    @type  parts: list
+
+    @returns: the 'moof' atom and the header of the 'mdat' atom, and
+              the ranges (offset, size) of the original file making up
+              the media data
+    @rtype:   str, list
+    """
+    def fields(track):
+        return track.cto_version is None and 3 or 4
+
+    moof_size = 8 + 16 + sum([8 + 16 + 20 + 20 + 4 * fields(tr) * len(ss)
+                              for tr, ss in parts])
+    data_size = sum([s[2] for tr, ss in parts for s in ss])
+    head_size = iso.mdat_head_size(data_size)
+
+    trafs = []
+    ranges = []
+    data_offset = moof_size + head_size
+    for track, samples in parts:
+        flags = DATA_OFFSET | SAMPLE_DURATION | SAMPLE_SIZE | SAMPLE_FLAGS
+        values = []
+        for dts, duration, size, sync, cto, offset in samples:
+            values.extend((duration, size, sync and SYNC_SAMPLE_FLAGS or
+                           NON_SYNC_SAMPLE_FLAGS))
+            if track.cto_version is not None:
+                values.append(cto)
+            if ranges and sum(ranges[-1]) == offset:
+                ranges[-1][1] += size
+            else:
+                ranges.append([offset, size])
+        if track.cto_version is not None:
+            flags |= SAMPLE_CTO
+        trun = _full_box('trun', track.cto_version or 0, flags,
+                         struct.pack('>Ll%dL' % len(values), len(samples),
+                                     data_offset, *values))
+        tfhd = _full_box('tfhd', 0, DEFAULT_BASE_IS_MOOF,
+                         struct.pack('>L', track.track_id))
+        tfdt = _full_box('tfdt', 1, 0, struct.pack('>Q', samples[0][0] -
+                                                   track.base_time))
+        trafs.append(_box('traf', tfhd + tfdt + trun))
+        data_offset += sum([s[2] for s in samples])
+
+    moof = _box('moof', _full_box('mfhd', 0, 0, struct.pack('>L', sequence)) +
+                ''.join(trafs))
+    if head_size == 8:
+        mdat_head = struct.pack('>L4s', data_size + 8, 'mdat')
+    else:
+        mdat_head = struct.pack('>L4sQ', 1, 'mdat', data_size + 16)
+    return moof + mdat_head, [tuple(r) for r in ranges]
+
+
+class FragmentedStream(object):
+    """Iterable over the fragmented version of a file.
+
+    The init segment is computed when the stream is created, the
+    fragments when they are reached. The stream takes over the file
+    object - it gets closed along with the stream.
+
+    @ivar init_segment: the 'ftyp' and 'moov' atoms of the output
+    @type init_segment: str
+    """
+
+    def __init__(self, f, t=0, chunk_size=CHUNK_SIZE, index=None,
+                 min_duration=None):
+        """
+        @param f: file to fragment
+        @type  f: file
+
+        @param t: start of the output, in seconds - nearest sync point
+                  will be used
+        @type  t: float
+
+        @param chunk_size: maximum size of the media data chunks
+        @type  chunk_size: int
+
+        @param index: seek index of the file, see L{iso.load_iso_file}
+        @type  index: L{sidecar.SeekIndex}
+
+        @param min_duration: minimum duration of the fragments, in
+                             seconds, see L{fragment_times}
+        @type  min_duration: float
+        """
+        self.f = f
+        self.chunk_size = chunk_size
+        aftyp, self._amoov, alist, syncs = iso.load_iso_file(f, index)
+        self.times = fragment_times(self._amoov, t, syncs, min_duration)
+
+        mvhd = self._amoov.mvhd
+        duration = max(mvhd.duration -
+                       int(round(self.times[0] * mvhd.timescale)), 0)
+        self.init_segment = make_ftyp() + make_init_moov(self._amoov,
+                                                         duration)
+
+    def fragments(self):
+        """Yields the fragments, one at a time, see L{make_fragment}."""
+        tracks = [_Track(a, self.times[0]) for a in self._amoov.trak]
+        sequence = 1
+        for end in self.times[1:] + [None]:
+            parts = [(tr, tr.take(end)) for tr in tracks]
+            parts = [(tr, ss) for tr, ss in parts if ss]
+            if not parts:
+                continue
+            yield make_fragment(sequence, parts)
+            sequence += 1
+
+    def __iter__(self):
+        yield self.init_segment
+        for header, ranges in self.fragments():
+            yield header
+            for data in self._iter_data(ranges):
+                yield data
+
+    def _iter_data(self, ranges):
+        # the ranges are small (single chunks of samples), joined into
+        # chunks of up to chunk_size bytes
+        buf, buffered = [], 0
+        for offset, size in ranges:
+            end = offset + size
+            while offset < end:
+                self.f.seek(offset)
+                data = self.f.read(min(self.chunk_size - buffered,
+                                       end - offset))
+                if not data:
+                    raise RuntimeError('Not enough data: file truncated'
+                                       ' at %d' % offset)
+                offset += len(data)
+                buf.append(data)
+                buffered += len(data)
+                if buffered >= self.chunk_size:
+                    yield ''.join(buf)
+                    buf, buffered = [], 0
+        if buf:
+            yield ''.join(buf)
+
+    def write(self, out_f):
+        """Write the whole output to out_f."""
+        out_f.write(self.init_segment)
+        for header, ranges in self.fragments():
+            out_f.write(header)
+            for offset, size in ranges:
+                transfer.copy_range(self.f, out_f, offset, size)
+
+    def close(self):
+        self.f.close()
+
+
+def fragment_and_write(in_f, out_f, t=0, min_duration=None):
+    FragmentedStream(in_f, t, min_duration=min_duration).write(out_f)
+
+
+def _children(data, offset=0, end=None):
+    # (type, start, end) of the atoms packed in data, start being the
+    # offset of the atom payload
+    if end is None:
+        end = len(data)
+    while offset + 8 <= end:
+        size, type = struct.unpack_from('>L4s', data, offset)
+        start = offset + 8
+        if size == 1:
+            size, = struct.unpack_from('>Q', data, start)
+            start += 8
+        if size < start - offset:
+            raise iso.FormatError('Invalid size of atom %r: %d' %
+                                  (type, size))
+        yield type, start, offset + size
+        offset += size
+
+def _handler_type(atrak):
+    hdlr = atrak.mdia._atom.get_children_dict().get('hdlr')
+    if not hdlr:
+        return None
+    a = hdlr[0]
+    a.seek_to_data()
+    a.skip(8)
+    return read_fcc(a.f)
+
+def reference_track(amoov):
+    """Returns the trak whose sync samples the splitting is done at:
+    the first video trak, the first trak if there is none."""
+    for atrak in amoov.trak:
+        if _handler_type(atrak) == 'vide':
+            return atrak
+    return amoov.trak[0]
+
+def _trex_defaults(amoov, track_id):
+    # default (duration, flags) of the samples of the track
+    mvex = amoov._atom.get_children_dict().get('mvex')
+    if mvex:
+        for a in atoms.container(mvex[0]).get_children_dict().get('trex', []):
+            a.seek_to_data()
+            values = struct.unpack('>6L', atoms.read_bytes(a.f, 24))
+            if values[1] == track_id:
+                return values[3], values[5]
+    return 0, 0
+
+def _moof_data(a):
+    a.seek_to_data()
+    return atoms.read_bytes(a.f, a.size - a.head_size())
+
+def read_traf(data, start, end, defaults):
+    """Parse a 'traf' atom, up to its first sync sample.
+
+    @param defaults: default sample duration and flags of the track
+    @type  defaults: tuple
+
+    @returns: track ID, flags of its 'tfhd', base decode time (from
+              'tfdt', None if there is none), decode time of the first
+              sync sample relative to it (None if there is none) and
+              the duration of all the samples
+    @rtype:   tuple
+    """
+    track_id = tfhd_flags = base_time = sync_time = None
+    duration, flags = defaults
+    total = 0
+    for type, cstart, cend in _children(data, start, end):
+        vf, = struct.unpack_from('>L', data, cstart)
+        v, bflags = vf >> 24, vf & 0xffffff
+        pos = cstart + 4
+        if type == 'tfhd':
+            track_id, = struct.unpack_from('>L', data, pos)
+            tfhd_flags = bflags
+            pos += 4
+            if bflags & BASE_DATA_OFFSET:
+                pos += 8
+            if bflags & SAMPLE_DESCRIPTION_INDEX:
+                pos += 4
+            if bflags & DEFAULT_SAMPLE_DURATION:
+                duration, = struct.unpack_from('>L', data, pos)
+                pos += 4
+            if bflags & DEFAULT_SAMPLE_SIZE:
+                pos += 4
+            if bflags & DEFAULT_SAMPLE_FLAGS:
+                flags, = struct.unpack_from('>L', data, pos)
+        elif type == 'tfdt':
+            base_time, = struct.unpack_from(v == 1 and '>Q' or '>L', data,
+                                            pos)
+        elif type == 'trun':
+            count, = struct.unpack_from('>L', data, pos)
+            pos += 4
+            if bflags & DATA_OFFSET:
+                pos += 4
+            first_flags = None
+            if bflags & FIRST_SAMPLE_FLAGS:
+                first_flags, = struct.unpack_from('>L', data, pos)
+                pos += 4
+            fields = [f for f in (SAMPLE_DURATION, SAMPLE_SIZE, SAMPLE_FLAGS,
+                                  SAMPLE_CTO) if bflags & f]
+            n = len(fields)
+            rows = struct.unpack_from('>%dL' % (count * n), data, pos)
+            durations = [duration] * count
+            if bflags & SAMPLE_DURATION:
+                durations = rows[fields.index(SAMPLE_DURATION)::n]
+            sflags = [flags] * count
+            if bflags & SAMPLE_FLAGS:
+                sflags = list(rows[fields.index(SAMPLE_FLAGS)::n])
+            if first_flags is not None and count:
+                sflags[0] = first_flags
+            if sync_time is None:
+                for i, sf in enumerate(sflags):
+                    if not sf & SAMPLE_IS_NON_SYNC:
+                        sync_time = total + sum(durations[:i])
+                        break
+            total += sum(durations)
+    return track_id, tfhd_flags, base_time, sync_time, total
+
+def scan_fragments(f, offset, track_id, defaults):
+    """Walk the top-level atoms from offset on, looking for the sync
+    samples of a track.
+
+    @returns: (decode time, offset) of the 'moof' atoms of the fragments
+              holding a sync sample of the track, the time being the
+              one of the first such sample, and the offset at which the
+              fragments end
+    @rtype:   list, int
+    """
+    found = []
+    time = 0
+    f.seek(offset)
+    end = offset
+    for a in atoms.read_atoms(f):
+        if a.type == 'mfra':
+            break
+        end = a.offset + a.size
+        if a.type != 'moof':
+            continue
+        data = _moof_data(a)
+        for type, start, tend in _children(data):
+            if type != 'traf':
+                continue
+            tid, tfhd_flags, base_time, sync_time, duration = \
+                read_traf(data, start, tend, defaults)
+            if tid != track_id:
+                continue
+            if base_time is not None:
+                time = base_time
+            if sync_time is not None and (not found or
+                                          found[-1][1] != a.offset):
+                found.append((time + sync_time, a.offset))
+            time += duration
+    return found, end
+
+def find_mfra(f):
+    """Returns the 'mfra' atom at the end of the file, located with the
+    'mfro' atom closing it - None if there is none."""
+    f.seek(0, 2)
+    size = f.tell()
+    if size < 16:
+        return None
+    f.seek(size - 16)
+    msize, type, vf, mfra_size = struct.unpack('>L4sLL',
+                                               atoms.read_bytes(f, 16))
+    if type != 'mfro' or msize != 16 or not 16 <= mfra_size <= size:
+        return None
+    f.seek(size - mfra_size)
+    a = atoms.read_atom(f)
+    if a.type != 'mfra' or a.size != mfra_size:
+        return None
+    return atoms.container(a)
+
+def read_tfra(a):
+    """Parse a 'tfra' atom.
+
+    @returns: track ID and the (time, moof offset) pairs of its entries
+    @rtype:   int, list
+    """
+    a.seek_to_data()
+    data = atoms.read_bytes(a.f, a.size - a.head_size())
+    vf, track_id, sizes, count = struct.unpack_from('>4L', data)
+    row = (vf >> 24 == 1 and 16 or 8) + (sizes >> 4 & 3) + \
+        (sizes >> 2 & 3) + (sizes & 3) + 3
+    fmt = vf >> 24 == 1 and '>QQ' or '>LL'
+    entries = [struct.unpack_from(fmt, data, 16 + i * row)
+               for i in xrange(count)]
+    return track_id, entries
+
+def find_fragments(f, amoov, moof):
+    """Find the fragments starting with a sync sample (or holding one)
+    of the reference track (see L{reference_track}), using the 'mfra'
+    index if there is one.
+
+    @param moof: the first 'moof' atom of the file
+    @type  moof: L{atoms.Atom}
+
+    @returns: (time, offset) of the fragments, the time in seconds, and
+              the offset at which the fragments end
+    @rtype:   list, int
+    """
+    atrak = reference_track(amoov)
+    track_id = _track_id(atrak)
+    ts = float(atrak.mdia.mdhd.timescale)
+
+    mfra = find_mfra(f)
+    if mfra is not None:
+        tfras = dict([read_tfra(a)
+                      for a in mfra.get_children_dict().get('tfra', [])])
+        if tfras and track_id not in tfras:
+            # no index of the reference track - taking what there is
+            track_id = min(tfras)
+            atrak = [a for a in amoov.trak if _track_id(a) == track_id][0]
+            ts = float(atrak.mdia.mdhd.timescale)
+        if track_id in tfras:
+            return ([(mt / ts, offset)
+                     for mt, offset in sorted(set(tfras[track_id]))],
+                    mfra.offset)
+
+    found, end = scan_fragments(f, moof.offset, track_id,
+                                _trex_defaults(amoov, track_id))
+    return [(mt / ts, offset) for mt, offset in found], end
+
+def _nearest(points, t):
+    times = [p[0] for p in points]
+    i = bisect_left(times, t)
+    if i == len(points) or (i > 0 and t - times[i - 1] <= times[i] - t):
+        i -= 1
+    return points[i]
+
+def split_fragments(out_f, amoov, alist, t, end_t=None):
+    """Split a fragmented file: write the atoms preceding the fragments
+    to out_f, to be followed by the fragments from the one holding the
+    sync sample nearest t on.
+
+    The data offsets of the fragments need to be relative to their
+    'moof' atoms - fragments with absolute ones can't be moved.
+
+    @param alist: top-level atoms up to the first 'moof' atom, as
+                  returned by L{iso.read_iso_file}
+    @type  alist: list
+
+    @param end_t: end of the clip, in seconds - the output ends before
+                  the first fragment with a sync sample after it
+    @type  end_t: float
+
+    @returns: range of the data of the original file (start, end) to
+              follow the header
+    @rtype:   tuple
+    """
+    moof = alist[-1]
+    f = moof.f
+    points, end = find_fragments(f, amoov, moof)
+
+    has_samples = [a for a in amoov.trak
+                   if len(a.mdia.minf.stbl.stts.table)]
+    if has_samples:
+        # the samples in 'moov' come first, kept as they are
+        points.insert(0, (0.0, None))
+    if not points:
+        raise iso.FormatError('No sync samples found - cannot seek')
+
+    start_t, offset = _nearest(points, t)
+    if end_t is not None:
+        later = [p[1] for p in points if p[0] > max(end_t, start_t)]
+        if later:
+            end = later[0]
+    if offset is None:
+        return 0, end
+
+    f.seek(offset)
+    data = _moof_data(atoms.read_atom(f))
+    for type, start, tend in _children(data):
+        if type == 'traf' and read_traf(data, start, tend, (0, 0))[1] & \
+                BASE_DATA_OFFSET:
+            raise iso.FormatError('Fragments with absolute data offsets'
+                                  ' - cannot seek')
+
+    head = [a for a in alist[:-1] if a.type != 'mdat']
+    if has_samples:
+        head[iso.find_atom(head, 'moov')] = amoov.copy(
+            trak=map(_empty_trak, amoov.trak))
+    iso.write_atoms(head, out_f)
+    return offset, end
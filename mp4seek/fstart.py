@@ -2,11 +2,54 @@ import os
 import sys
 import shutil
 import tempfile
+import time
 
+from mp4seek import atoms
+from mp4seek import inplace
 from mp4seek.iso import move_header_and_write
+from mp4seek.transfer import copy_range
 
+# file name extensions looked for when walking directories in batch mode
+EXTENSIONS = ('.mp4', '.m4v', '.m4a', '.mov', '.3gp', '.f4v')
+
+
+def needs_faststart(fobj):
+    """Tell whether the 'moov' atom of the file has to be moved, from
+    the top-level atom headers alone - without parsing any boxes.
+
+    @returns: False if the 'moov' atom precedes the media data
+    @rtype:   bool
+    """
+    fobj.seek(0)
+    for a in atoms.read_atoms(fobj):
+        if a.type == 'moov':
+            return False
+        if a.type == 'mdat':
+            return True
+    # let the full parsing complain
+    return True
+
+def fstart_file(inpath, outpath=None, in_place=False, compact=False):
+    """
+    @param compact: whether to store the sample sizes in the smallest
+                    boxes possible, see L{iso.compact_trak}
+    @type  compact: bool
+
+    @returns: True if the header was moved
+    @rtype:   bool
+    """
+    if not outpath and not os.path.exists(inplace.journal_path(inpath)):
+        fi = open(inpath, 'rb')
+        try:
+            if not needs_faststart(fi):
+                return False
+        finally:
+            fi.close()
+
+    if in_place and not outpath:
+        # no temporary copy of the whole file, see inplace.faststart
+        return inplace.faststart(inpath, compact=compact)
 
-def fstart_file(inpath, outpath=None):
     fi = open(inpath, 'rb')
     if outpath:
         fo = open(outpath, 'wb')
@@ -15,13 +58,12 @@ def fstart_file(inpath, outpath=None):
         shutil.copymode(inpath, temppath)
         fo = os.fdopen(fd, 'wb')
 
-    moved = move_header_and_write(fi, fo)
+    moved = move_header_and_write(fi, fo, compact)
 
     fo.flush()
     if not moved and outpath:
         # no changes, but output file specified
-        fi.seek(0)
-        shutil.copyfileobj(fi, fo)
+        copy_range(fi, fo, 0)
     if moved and not outpath:
         # some changes and using temporary file
         fo.close()
@@ -29,13 +71,148 @@ def fstart_file(inpath, outpath=None):
 
     fi.close()
     fo.close()
+    return moved
+
+def find_files(paths, extensions=EXTENSIONS):
+    """Expand the directories in paths into the files with the given
+    extensions found (recursively) in them."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if os.path.splitext(name)[1].lower() in extensions:
+                    yield os.path.join(dirpath, name)
+
+def _fstart_one(args):
+    path, in_place, compact = args
+    start = time.time()
+    try:
+        size = os.path.getsize(path)
+        moved = fstart_file(path, None, in_place, compact)
+    except Exception, e:
+        return path, None, 0, time.time() - start, str(e)
+    return path, moved, size, time.time() - start, None
+
+def fstart_batch(paths, jobs=None, in_place=False, report=None,
+                 compact=False):
+    """Move the headers of many files, in parallel.
+
+    @param paths: files and directories (walked recursively) to process
+    @type  paths: iterable
+
+    @param jobs: number of worker processes - as many as CPUs if None,
+                 none at all if 1
+    @type  jobs: int or None
+
+    @param report: called with (path, moved, size, seconds, error) for
+                   each processed file, moved being None on error
+    @type  report: callable
+
+    @returns: totals - numbers of files, moved files and errors, bytes
+              in all the files, and the elapsed seconds
+    @rtype:   dict
+    """
+    tasks = ((path, in_place, compact) for path in find_files(paths))
+    start = time.time()
+    pool = None
+    if jobs != 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap_unordered(_fstart_one, tasks, 16)
+    else:
+        results = (_fstart_one(task) for task in tasks)
+
+    totals = dict(files=0, moved=0, errors=0, bytes=0)
+    try:
+        for result in results:
+            path, moved, size, seconds, error = result
+            totals['files'] += 1
+            totals['bytes'] += size
+            if error is not None:
+                totals['errors'] += 1
+            elif moved:
+                totals['moved'] += 1
+            if report:
+                report(*result)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    totals['seconds'] = time.time() - start
+    return totals
+
+def _print_result(path, moved, size, seconds, error):
+    if error is not None:
+        print >>sys.stderr, '%s: %s' % (path, error)
+    else:
+        print '%s %s (%.3fs)' % (moved and 'moved' or 'ok', path, seconds)
+
+def _read_file_list(path):
+    f = (path == '-' and sys.stdin) or open(path)
+    try:
+        return [line.rstrip('\r\n') for line in f if line.strip()]
+    finally:
+        if f is not sys.stdin:
+            f.close()
 
 def main():
-    if not 2 <= len(sys.argv) <= 3:
-        print >>sys.stderr, "Usage: %s infile [outfile]" % sys.argv[0]
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [-i] [-c] infile [outfile]\n'
+                          '       %prog -b [-i] [-c] [-j jobs] [-f list]'
+                          ' [path ...]')
+    parser.add_option('-i', '--in-place', dest='in_place',
+                      action='store_true', default=False,
+                      help='modify files in place instead of replacing'
+                      ' them with rewritten copies')
+    parser.add_option('-c', '--compact', dest='compact',
+                      action='store_true', default=False,
+                      help='store the sample sizes in the smallest boxes'
+                      ' possible')
+    parser.add_option('-b', '--batch', dest='batch',
+                      action='store_true', default=False,
+                      help='process all the given files and (recursively)'
+                      ' directories, in parallel')
+    parser.add_option('-f', '--file-list', dest='file_list', default=None,
+                      help='read the paths to process in batch mode from'
+                      ' a file, one per line (- for stdin)')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=None,
+                      help='number of worker processes in batch mode'
+                      ' (default: number of CPUs)')
+    parser.add_option('-q', '--quiet', dest='quiet',
+                      action='store_true', default=False,
+                      help='only report errors and totals in batch mode')
+    options, args = parser.parse_args()
+
+    if options.batch or options.file_list:
+        if options.file_list:
+            args.extend(_read_file_list(options.file_list))
+        if not args:
+            parser.error('no files given')
+        report = _print_result
+        if options.quiet:
+            def report(path, moved, size, seconds, error):
+                if error is not None:
+                    _print_result(path, moved, size, seconds, error)
+        totals = fstart_batch(args, options.jobs, options.in_place, report,
+                              options.compact)
+        seconds = max(totals['seconds'], 1e-6)
+        print >>sys.stderr, ('%d files (%d moved, %d failed), %.1f MB'
+                             ' in %.1fs: %.1f files/s, %.1f MB/s' %
+                             (totals['files'], totals['moved'],
+                              totals['errors'], totals['bytes'] / 1e6,
+                              seconds, totals['files'] / seconds,
+                              totals['bytes'] / 1e6 / seconds))
+        sys.exit(totals['errors'] and 1 or 0)
+
+    if not 1 <= len(args) <= 2:
+        parser.print_usage(sys.stderr)
         sys.exit(2)
     try:
-        fstart_file(sys.argv[1], (len(sys.argv) > 2 and sys.argv[2]) or None)
+        fstart_file(args[0], (len(args) > 1 and args[1]) or None,
+                    options.in_place, options.compact)
     except Exception, e:
         try:
             print >>sys.stderr, e
@@ -0,0 +1,297 @@
+"""Moving the 'moov' atom to the front of a file in place.
+
+Instead of writing a rewritten copy of the file, the data between the
+new and the old position of the 'moov' atom is moved inside the file
+itself: with fallocate(2) INSERT_RANGE where the filesystem supports it
+(only the file extents get shifted), otherwise by copying it towards
+the end of the file, starting from its end, through a bounded buffer.
+
+Before the file is touched, the operation (with the rewritten 'moov'
+atom) is recorded in a journal next to it, and its progress is
+appended to the journal as it goes, so that an interrupted operation
+can be completed with L{recover}. L{faststart} does so itself when it
+finds a journal left over.
+"""
+
+import errno
+import marshal
+import os
+import struct
+import tempfile
+from cStringIO import StringIO
+
+import iso
+import transfer
+
+JOURNAL_SUFFIX = '.fstart-journal'
+
+# maximum number of bytes copied at once when shifting the data
+BUFFER_SIZE = 1024 * 1024
+
+_FORMAT = ('mp4seek-fstart-journal', 1)
+
+_HEADER = '>I'
+_PROGRESS = '>Q'
+
+# entries of the recorded operations, by method
+_KEYS = {
+    'insert': ('size', 'offset', 'length', 'header', 'truncate', 'free'),
+    'shift': ('size', 'offset', 'length', 'header', 'end', 'truncate',
+              'free'),
+}
+
+_UNSUPPORTED = (errno.EINVAL, errno.ENOSYS,
+                getattr(errno, 'EOPNOTSUPP', errno.EINVAL))
+
+
+def journal_path(path):
+    return path + JOURNAL_SUFFIX
+
+def _file_size(fobj):
+    return os.fstat(fobj.fileno()).st_size
+
+def _sync(fobj):
+    fobj.flush()
+    os.fsync(fobj.fileno())
+
+def _moov_data(amoov, data_offset):
+    # offsets get changed in place - data_offset adds up between calls
+    iso.change_chunk_offsets(amoov, data_offset)
+    s = StringIO()
+    amoov.write(s)
+    return s.getvalue()
+
+
+def _plan_insert(f, amoov, start, old_moov, block_size):
+    # The hole has to be block-aligned, so it starts at the block
+    # boundary before start: the bytes in between get written back in
+    # front of the new 'moov', and the slack after it (ending with the
+    # original copy of those bytes) is covered with a 'free' atom.
+    offset = start - start % block_size
+    moov_size = amoov.get_size()
+    length = -(-moov_size // block_size) * block_size
+    if 0 < length - moov_size < 8:
+        length += block_size
+
+    f.seek(offset)
+    header = f.read(start - offset) + _moov_data(amoov, length)
+    if length > moov_size:
+        header += struct.pack('>I4s', length - moov_size, 'free')
+
+    size = _file_size(f)
+    j = dict(method='insert', size=size, offset=offset, length=length,
+             header=header, truncate=None, free=None)
+    if old_moov.offset + old_moov.size >= size:
+        j['truncate'] = old_moov.offset + length
+    else:
+        # keep the rest of the file in place, just hide the old 'moov'
+        j['free'] = old_moov.offset + length + 4
+    return j
+
+def _plan_shift(f, amoov, start, old_moov, data_offset):
+    # data_offset - the offset change already applied to amoov
+    length = amoov.get_size()
+    size = _file_size(f)
+    moov_last = old_moov.offset + old_moov.size >= size
+    if not moov_last and length != old_moov.size:
+        # the atoms following 'moov' would need moving too
+        return None
+
+    j = dict(method='shift', size=size, offset=start, length=length,
+             header=_moov_data(amoov, length - data_offset),
+             end=old_moov.offset, truncate=None, free=None)
+    if moov_last:
+        j['truncate'] = old_moov.offset + length
+    return j
+
+
+def _write_journal(path, j):
+    jpath = journal_path(path)
+    data = marshal.dumps((_FORMAT, j))
+    fd, temppath = tempfile.mkstemp(dir=os.path.dirname(jpath) or '.')
+    try:
+        fo = os.fdopen(fd, 'wb')
+        fo.write(struct.pack(_HEADER, len(data)) + data)
+        _sync(fo)
+        fo.close()
+        os.rename(temppath, jpath)
+    except:
+        os.unlink(temppath)
+        raise
+    return open(jpath, 'ab')
+
+def _read_journal(path):
+    jpath = journal_path(path)
+    jf = open(jpath, 'rb')
+    try:
+        hsize = struct.calcsize(_HEADER)
+        data = jf.read(hsize)
+        if len(data) != hsize:
+            raise ValueError('Corrupt journal %s: truncated header' % jpath)
+        dsize, = struct.unpack(_HEADER, data)
+        data = jf.read(dsize)
+        if len(data) != dsize:
+            raise ValueError('Corrupt journal %s: %d bytes of data instead'
+                             ' of %d' % (jpath, len(data), dsize))
+        try:
+            loaded = marshal.loads(data)
+        except (ValueError, EOFError, TypeError):
+            raise ValueError('Corrupt journal %s: invalid data' % jpath)
+        if not (isinstance(loaded, tuple) and len(loaded) == 2 and
+                loaded[0] == _FORMAT):
+            raise ValueError('Unknown journal format in %s' % jpath)
+        j = loaded[1]
+        if not (isinstance(j, dict) and
+                j.get('method') in _KEYS and
+                not [k for k in _KEYS[j['method']] if k not in j]):
+            raise ValueError('Corrupt journal %s: invalid operation' % jpath)
+        psize = struct.calcsize(_PROGRESS)
+        progress = 0
+        while True:
+            data = jf.read(psize)
+            if len(data) < psize:
+                # possibly a partially written last record
+                break
+            progress, = struct.unpack(_PROGRESS, data)
+    finally:
+        jf.close()
+    return j, progress
+
+def _record(jf, progress):
+    jf.write(struct.pack(_PROGRESS, progress))
+    _sync(jf)
+
+
+def _shift(f, jf, start, end, delta, done):
+    # Move [start, end) delta bytes forward, from the end, done bytes
+    # having been moved already. Copying at most delta bytes between
+    # the progress records never overwrites data that would be needed
+    # again when restarting from the last record.
+    chunk = min(BUFFER_SIZE, delta)
+    pos = end - done
+    while pos > start:
+        batch_start = max(start, pos - delta)
+        while pos > batch_start:
+            n = min(chunk, pos - batch_start)
+            pos -= n
+            f.seek(pos)
+            data = f.read(n)
+            if len(data) != n:
+                raise RuntimeError('Not enough data: file truncated at %d'
+                                   % (pos + len(data)))
+            f.seek(pos + delta)
+            f.write(data)
+        _sync(f)
+        _record(jf, end - pos)
+
+def _run(f, jf, j, progress):
+    if j['method'] == 'insert':
+        if not progress and _file_size(f) == j['size']:
+            f.flush()
+            transfer.insert_range(f.fileno(), j['offset'], j['length'])
+            _record(jf, 1)
+    else:
+        _shift(f, jf, j['offset'], j['end'], j['length'], progress)
+
+    # everything from here on can simply be done again
+    f.seek(j['offset'])
+    f.write(j['header'])
+    if j['free'] is not None:
+        f.seek(j['free'])
+        f.write('free')
+    if j['truncate'] is not None:
+        f.truncate(j['truncate'])
+    _sync(f)
+
+def recover(path):
+    """Complete an interrupted L{faststart} of the file at path.
+
+    @returns: True if there was an operation to complete
+    @rtype:   bool
+
+    @raise ValueError: if the journal is corrupt - it is left in place,
+                       for the file to be inspected
+    """
+    jpath = journal_path(path)
+    if not os.path.exists(jpath):
+        return False
+    j, progress = _read_journal(path)
+    f = open(path, 'r+b')
+    try:
+        jf = open(jpath, 'ab')
+        try:
+            _run(f, jf, j, progress)
+        finally:
+            jf.close()
+    finally:
+        f.close()
+    os.unlink(jpath)
+    return True
+
+def faststart(path, use_insert=True, compact=False):
+    """Move the 'moov' atom of the file at path in front of the media
+    data, modifying the file in place.
+
+    @param use_insert: try moving the data with fallocate(2) first
+    @type  use_insert: bool
+
+    @param compact: whether to store the sample sizes in the smallest
+                    boxes possible, see L{iso.compact_trak}
+    @type  compact: bool
+
+    @returns: True if the file was changed, False if the 'moov' atom
+              was already in front of the media data
+    @rtype:   bool
+
+    @raise ValueError: if the file can't be changed in place (the
+                       'moov' atom would change size, with other
+                       atoms following it), or if a journal left over
+                       is corrupt
+    """
+    if recover(path):
+        return True
+
+    f = open(path, 'r+b')
+    try:
+        aftyp, amoov, alist = iso.read_iso_file(f)
+        placement = iso.find_moov_placement(alist)
+        if placement is None:
+            return False
+        moov_idx, new_moov_idx = placement
+        if compact:
+            amoov = iso.compact_moov(amoov)
+        start, old_moov = alist[new_moov_idx].offset, alist[moov_idx]
+
+        j = None
+        data_offset = 0
+        if use_insert:
+            j = _plan_insert(f, amoov, start, old_moov,
+                             os.fstat(f.fileno()).st_blksize)
+            data_offset = j['length']
+            jf = _write_journal(path, j)
+            try:
+                _run(f, jf, j, 0)
+            except OSError, e:
+                jf.close()
+                if e.errno not in _UNSUPPORTED:
+                    raise
+                # nothing has been changed yet
+                os.unlink(journal_path(path))
+                j = None
+            else:
+                jf.close()
+
+        if j is None:
+            j = _plan_shift(f, amoov, start, old_moov, data_offset)
+            if j is None:
+                raise ValueError("Can't move the 'moov' atom in place")
+            jf = _write_journal(path, j)
+            try:
+                _run(f, jf, j, 0)
+            finally:
+                jf.close()
+    finally:
+        f.close()
+
+    os.unlink(journal_path(path))
+    return True
@@ -1,8 +1,16 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import izip
 from math import ceil
+import copy
 import struct
+import sys
 
 import atoms
 from atoms import read_fcc, read_ulong, read_ulonglong
+import observe
+import transfer
+import vector
 
 
 def write_ulong(fobj, n):
@@ -16,17 +24,125 @@ def write_fcc(fobj, fcc_str):
     fobj.write('%-4.4s' % fcc_str)
 
 
+def _find_typecode(itemsize, candidates):
+    for tc in candidates:
+        try:
+            if array(tc).itemsize == itemsize:
+                return tc
+        except ValueError:
+            pass
+    return None
+
+# array typecodes for unsigned 32- and 64-bit table cells - there might
+# be no 64-bit array type available, plain lists are used then
+U32 = _find_typecode(4, 'IL')
+U64 = _find_typecode(8, 'LQ')
+
+_row_spec_typecodes = {'B': 'B', 'H': 'H', 'L': U32, 'Q': U64}
+
+def new_table(typecode, seq=()):
+    """Create a single-column table of the given array typecode."""
+    if typecode is None:
+        return list(seq)
+    return array(typecode, seq)
+
+def table_typecode(t):
+    return getattr(t, 'typecode', None)
+
+def _needs_byteswap(spec_prefix):
+    if spec_prefix in ('>', '!'):
+        return sys.byteorder == 'little'
+    if spec_prefix == '<':
+        return sys.byteorder == 'big'
+    return False
+
+def unpack_array(typecode, data, spec_prefix='>'):
+    """Unpack a string (or buffer) of packed integers into a typed array."""
+    if typecode is None:
+        n = len(data) // 8
+        return list(struct.unpack_from('%s%dQ' % (spec_prefix, n), data))
+    a = array(typecode)
+    a.fromstring(data)
+    if a.itemsize > 1 and _needs_byteswap(spec_prefix):
+        a.byteswap()
+    return a
+
+def pack_array(a, fmt, spec_prefix='>'):
+    """Pack a typed array (or a list) of integers into a string, the
+    reverse of L{unpack_array}.
+
+    @param fmt: L{struct} format of a single value
+    @type  fmt: str
+    """
+    typecode = table_typecode(a)
+    if typecode is None or a.itemsize != struct.calcsize('>' + fmt):
+        return struct.pack('%s%d%s' % (spec_prefix, len(a), fmt), *a)
+    if a.itemsize > 1 and _needs_byteswap(spec_prefix):
+        a = a[:]
+        a.byteswap()
+    return a.tostring()
+
+
+class Table(object):
+    """Multi-column table, stored as parallel typed column arrays.
+
+    Indexing returns rows as tuples, slicing returns a new L{Table}.
+    """
+
+    def __init__(self, *columns):
+        self.columns = list(columns)
+
+    @classmethod
+    def from_rows(cls, rows, typecodes):
+        cols = zip(*rows) or [()] * len(typecodes)
+        return cls(*[new_table(tc, col) for tc, col in izip(typecodes, cols)])
+
+    def typecodes(self):
+        return [table_typecode(c) for c in self.columns]
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.__class__(*[c[i] for c in self.columns])
+        return tuple([c[i] for c in self.columns])
+
+    def __setitem__(self, i, row):
+        for c, v in izip(self.columns, row):
+            c[i] = v
+
+    def __iter__(self):
+        return izip(*self.columns)
+
+    def insert(self, i, row):
+        for c, v in izip(self.columns, row):
+            c.insert(i, v)
+
+    def extend(self, other):
+        for c, oc in izip(self.columns, other.columns):
+            c.extend(oc)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join([repr(c) for c in self.columns]))
+
+
 def takeby(seq, n, force_tuples=False):
     if n == 1 and not force_tuples:
         return seq
     return [tuple(seq[i:i + n]) for i in xrange(0, len(seq), n)]
 
 def read_table(f, row_spec, entries, spec_prefix='>'):
-    """Read a continuous region of file and unpack it into a list of
-    tuples using the given struct specification of a single row.
+    """Read a continuous region of file and unpack it into a table of
+    typed arrays using the given struct specification of a single row.
+
+    Single-column tables are returned as a plain array, tables with
+    more columns as a L{Table} of parallel column arrays.
 
     @param row_spec: spec describing single row of table using same
-                     syntax as in L{struct} module.
+                     syntax as in L{struct} module, all the columns
+                     need to be of the same type
     @type  row_spec: str
 
     @param entries: number of rows to read
@@ -36,16 +152,36 @@ def read_table(f, row_spec, entries, spec_prefix='>'):
                         the whole table
     @type  spec_prefix: str
     """
+    if row_spec != row_spec[0] * len(row_spec):
+        raise ValueError('Mixed column types not supported: %r' % row_spec)
     row_bytes = struct.calcsize('%s%s' % (spec_prefix, row_spec))
-    data = f.read(row_bytes * entries)
-    try:
-        l = struct.unpack('%s%s' % (spec_prefix, row_spec * entries), data)
-    except struct.error:
-        raise RuntimeError('Not enough data: requested %d, read %d' %
-                           (row_bytes * entries, len(data)))
-
-    per_row = len(l) / entries
-    return takeby(l, per_row)
+    data = atoms.read_view(f, row_bytes * entries)
+    a = unpack_array(_row_spec_typecodes[row_spec[0]], data, spec_prefix)
+    per_row = len(row_spec)
+    if per_row == 1:
+        return a
+    return Table(*[a[i::per_row] for i in xrange(per_row)])
+
+def pack_table(t, row_spec, spec_prefix='>'):
+    """Pack a table, as returned by L{read_table}, into a string - the
+    rows one after the other, the columns interleaved."""
+    per_row = len(row_spec)
+    if per_row == 1:
+        return pack_array(t, row_spec[0], spec_prefix)
+
+    columns = getattr(t, 'columns', None)
+    typecode = columns and table_typecode(columns[0])
+    if typecode is None or [c for c in columns
+                            if table_typecode(c) != typecode]:
+        flat = []
+        for row in t:
+            flat.extend(row)
+        return pack_array(flat, row_spec[0], spec_prefix)
+
+    rows = array(typecode, [0]) * (len(t) * per_row)
+    for i, c in enumerate(columns):
+        rows[i::per_row] = c
+    return pack_array(rows, row_spec[0], spec_prefix)
 
 class UnsuportedVersion(Exception):
     pass
@@ -97,22 +233,69 @@ class Box(object):
     def copy(self, *a, **kw):
         cls = self.__class__
         if getattr(self, '_fields', None):
-            attribs = dict([(k, getattr(self, k)) for k in self._fields])
+            attribs = dict([(k, self.get_raw(k)) for k in self._fields])
             attribs.update(dict([(k, kw[k]) for k in self._fields if k in kw]))
         else:
             attribs = {}
         return cls(self._atom, **attribs)
 
+    def bound(self, fobj):
+        """Returns a copy of the box (and all its children) reading the
+        source data from fobj. The parsed tables, and the indexes built
+        from them, are shared with the original box."""
+        b = copy.copy(self)
+        b._atom = self._atom.bound(fobj)
+        for k in getattr(self, '_fields', ()):
+            setattr(b, k, _bound_value(self.get_raw(k), fobj))
+        return b
+
+    def get_raw(self, field):
+        """Returns the value of a field without parsing it, i.e. the
+        child L{atoms.Atom} for fields that are loaded lazily and have
+        not been accessed yet (see L{lazybox})."""
+        return self.__dict__.get(field)
+
     def write(self, fobj):
         # print '[ b] writing:', self
         self._atom.write(fobj)
 
     def write_head(self, fobj):
-        # assuming 'short' sizes for now - FIXME!
         # print '[ b] writing head:', self._atom
-        a = self._atom
-        write_ulong(fobj, self.get_size())
-        write_fcc(fobj, a.type)
+        fobj.write(self.head_data())
+
+    def head_data(self):
+        # assuming 'short' sizes for now - FIXME!
+        return struct.pack('>L', self.get_size()) + '%-4.4s' % self._atom.type
+
+def _bound_value(v, fobj):
+    if isinstance(v, (Box, atoms.Atom)):
+        return v.bound(fobj)
+    if isinstance(v, list):
+        return [_bound_value(elt, fobj) for elt in v]
+    return v
+
+class lazybox(object):
+    """Descriptor of a box field holding a single child box, parsed
+    from its atom only when the field is first accessed."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        v = obj.__dict__.get(self.name)
+        if isinstance(v, atoms.Atom):
+            started = observe.clock()
+            v = maybe_build_atoms(v.type, [v])[0]
+            obj.__dict__[self.name] = v
+            # the same size, but the layout has to list the parsed box
+            obj.__dict__.pop('_layout', None)
+            observe.phase('parse', started)
+        return v
+
+    def __set__(self, obj, v):
+        obj.__dict__[self.name] = v
 
 class FullBox(Box):
     def tabled_size(self, body_size, loop_size):
@@ -120,55 +303,93 @@ class FullBox(Box):
         return (self._atom.head_size_ext() + body_size +
                 len(self.table) * loop_size)
 
-    def write_head(self, fobj):
-        Box.write_head(self, fobj)
+    def head_data(self):
         a = self._atom
-        write_ulong(fobj, (a.v & 0xff) << 24 | (a.flags & 0xffffff))
+        return Box.head_data(self) + struct.pack('>L', (a.v & 0xff) << 24 |
+                                                 (a.flags & 0xffffff))
+
+    def write_table(self, fobj, row_spec, *values):
+        """Write the box: its head, the given 32-bit values, the number
+        of entries of the table and the table itself, packed in bulk."""
+        values = values + (len(self.table),)
+        fobj.write(self.head_data() +
+                   struct.pack('>%dL' % len(values), *values))
+        if len(self.table):
+            fobj.write(pack_table(self.table, row_spec))
 
 class ContainerBox(Box):
-    def get_size(self):
-        # print '[>] getting size: %r' % self._atom
-        fields = getattr(self, '_fields', [])
-        cd = self._atom.get_children_dict()
-        size = self._atom.head_size_ext()
-        for k, v in cd.items():
-            if k in fields:
-                v = getattr(self, k)
-                if not isinstance(v, (tuple, list)):
-                    if v is None:
-                        v = []
-                    else:
-                        v = [v]
-            # print 'size for %r = %r' % (sum([a.get_size() for a in v]), v)
-            size += sum([a.get_size() for a in v])
-        # print '[<] getting size: %r = %r' % (self._atom, size)
-        return size
+    """Box made of child boxes.
 
-    def write(self, fobj):
-        self.write_head(fobj)
+    The size and the layout of the children are computed once and
+    memoized: the boxes are modified by making copies of them (see
+    L{Box.copy}), which start afresh. Setting a field of a container
+    directly drops its memoized values - but not the ones of the
+    containers holding it.
+    """
+
+    def __setattr__(self, name, v):
+        if name in getattr(self, '_fields', ()):
+            self.__dict__.pop('_size', None)
+            self.__dict__.pop('_layout', None)
+        Box.__setattr__(self, name, v)
+
+    def bound(self, fobj):
+        size = self.__dict__.get('_size')
+        b = Box.bound(self, fobj)
+        if size is not None:
+            b._size = size
+        return b
+
+    def get_layout(self):
+        """Returns the children to write, in the order of their original
+        offsets - boxes for the fields and raw atoms for the rest."""
+        layout = self.__dict__.get('_layout')
+        if layout is not None:
+            return layout
 
         fields = getattr(self, '_fields', [])
         cd = self._atom.get_children_dict()
-        to_write = []
+        layout = []
         for k, v in cd.items():
             if k in fields:
-                v = getattr(self, k)
+                v = self.get_raw(k)
                 if not isinstance(v, (tuple, list)):
                     if v is None:
                         v = []
                     else:
                         v = [v]
-            to_write.extend(v)
+            layout.extend(v)
+        for k in fields:
+            # children set in place of ones of other types
+            v = self.get_raw(k)
+            if k not in cd and v is not None:
+                if not isinstance(v, (tuple, list)):
+                    v = [v]
+                layout.extend(v)
 
         def _get_offset(a):
             return a.get_offset()
 
-        to_write.sort(key=_get_offset)
+        layout.sort(key=_get_offset)
+        self._layout = layout
+        return layout
+
+    def get_size(self):
+        size = self.__dict__.get('_size')
+        if size is None:
+            size = self._atom.head_size_ext()
+            for ca in self.get_layout():
+                size += ca.get_size()
+            self._size = size
+        return size
+
+    def write(self, fobj):
+        self.write_head(fobj)
 
         # print '[  ] going to write:', \
         #     ([(isinstance(a, Box) and a._atom.type or a.type)
-        #       for a in to_write])
-        for ca in to_write:
+        #       for a in self.get_layout()])
+        for ca in self.get_layout():
             # print '[cb] writing:', ca
             ca.write(fobj)
 
@@ -198,12 +419,14 @@ def maybe_build_atoms(atype, alist):
         return map(cls.read, alist)
     return alist
 
-def select_children_atoms(a, *selection):
-    return select_atoms(a.get_children_dict(), *selection)
+def select_children_atoms(a, *selection, **kw):
+    return select_atoms(a.get_children_dict(), *selection, **kw)
 
-def select_atoms(ad, *selection):
+def select_atoms(ad, *selection, **kw):
     """ad: atom dict
-    selection: [(type, min_required, max_required), ...]"""
+    selection: [(type, min_required, max_required), ...]
+    build: whether to parse the selected atoms into boxes (default)"""
+    build = kw.get('build', True)
     selected = []
     for atype, req_min, req_max in selection:
         alist = ad.get(atype, [])
@@ -213,7 +436,8 @@ def select_atoms(ad, *selection):
             raise CannotSelect('requested number of atoms %r: in [%s; %s],'
                                ' found: %d (all children: %r)' %
                                (atype, req_min, req_max, found, ad))
-        alist = maybe_build_atoms(atype, alist)
+        if build:
+            alist = maybe_build_atoms(atype, alist)
         if req_max == 1:
             if found == 0:
                 selected.append(None)
@@ -231,72 +455,73 @@ def write_atoms(alist, f):
     for a in alist:
         a.write(f)
 
-def find_samplenum_stts(stts, mt):
+def build_sctts_index(sctts, with_times=True):
+    """Build cumulative index of a run-length 'stts'/'ctts' table.
+
+    @returns: 1-based numbers of the first sample of each run and
+              (optionally) media times at which the runs start - with
+              an extra trailing entry marking the end of the table
+    @rtype:   (array, array or None)
+    """
+    counts, deltas = sctts.columns
+    starts = vector.cumsum(U64, counts, 1)
+    times = None
+    if with_times:
+        times = vector.cumsum(U64, vector.multiply(U64, counts, deltas), 0)
+    return starts, times
+
+def build_stsc_index(stsc):
+    """Build cumulative index of a 'stsc' table.
+
+    @returns: 1-based numbers of the first sample of each entry
+    @rtype:   array
+    """
+    if not len(stsc):
+        return new_table(U64)
+    firsts, per_chunks = stsc.columns[:2]
+    chunks = vector.diff(table_typecode(firsts), firsts)
+    return vector.cumsum(U64, vector.multiply(U64, chunks,
+                                              per_chunks[:len(chunks)]), 1)
+
+def find_samplenum_stts(stts, mt, index=None):
     "stts - table of the 'stts' atom; mt - media time"
-    ctime = 0
-    samples = 1
-    i, n = 0, len(stts)
-    while i < n:
-        # print 'fsstts:', mt, ctime, stts[i], samples, ctime
-        if mt == ctime:
-            break
-        count, delta = stts[i]
-        cdelta = count * delta
-        if mt < ctime + cdelta:
-            samples += int(ceil((mt - ctime) / float(delta)))
-            break
-        ctime += cdelta
-        samples += count
-        i += 1
-
-    return samples
-
-def find_mediatime_stts(stts, sample):
-    ctime = 0
-    samples = 1
-    i, n = 0, len(stts)
-    while i < n:
-        count, delta = stts[i]
-        if samples + count >= sample:
-            return ctime + (sample - samples) * delta
-        ctime += count * delta
-        samples += count
-        i += 1
-    return ctime
-
-def find_mediatimes(stts, samples):
-    ctime = 0
-    total_samples = 1
-    ret = []
-    i, n = 0, len(stts)
-    j, m = 0, len(samples)
-    while i < n and j < m:
-        count, delta = stts[i]
-        sample = samples[j]
-        if total_samples + count >= sample:
-            ret.append(ctime + (sample - total_samples) * delta)
-            j += 1
-            continue
-        ctime += count * delta
-        total_samples += count
-        i += 1
-    return ret
-
-def find_chunknum_stsc(stsc, sample_num):
-    current = 1                 # 1-based indices!
-    per_chunk = 0
-    samples = 1
-    i, n = 0, len(stsc)
-    while i < n:
-        # print 'fcnstsc:', sample_num, current, stsc[i], samples, per_chunk
-        next, next_per_chunk, _sdidx = stsc[i]
-        samples_here = (next - current) * per_chunk
-        if samples + samples_here > sample_num:
-            break
-        samples += samples_here
-        current, per_chunk = next, next_per_chunk
-        i += 1
-    return int((sample_num - samples) // per_chunk + current)
+    if index is None:
+        index = build_sctts_index(stts)
+    starts, times = index
+    n = len(stts)
+    i = bisect_left(times, mt)
+    if i <= n and times[i] == mt:
+        return starts[i]
+    i -= 1
+    if i >= n:
+        return starts[n]
+    i = max(i, 0)
+    delta = stts.columns[1][i]
+    return starts[i] + int(ceil((mt - times[i]) / float(delta)))
+
+def find_mediatime_stts(stts, sample, index=None):
+    if index is None:
+        index = build_sctts_index(stts)
+    starts, times = index
+    n = len(stts)
+    i = bisect_left(starts, sample, 1) - 1
+    if i >= n:
+        return times[n]
+    return times[i] + (sample - starts[i]) * stts.columns[1][i]
+
+def find_mediatimes(stts, samples, index=None):
+    if index is None:
+        index = build_sctts_index(stts)
+    starts, times = index
+    return vector.mediatimes(starts, times, stts.columns[1], samples)
+
+def find_chunknum_stsc(stsc, sample_num, index=None):
+    # 1-based indices!
+    if index is None:
+        index = build_stsc_index(stsc)
+    firsts, per_chunks = stsc.columns[:2]
+    i = max(bisect_right(index, sample_num, 1) - 1, 0)
+    return int((sample_num - index[i]) // per_chunks[i] + firsts[i])
 
 def get_chunk_offset(stco64, chunk_num):
     # 1-based indices!
@@ -412,12 +637,15 @@ class stts(FullBox):
     def get_size(self):
         return self.tabled_size(4, 8)
 
+    def get_index(self):
+        """Cumulative sample numbers and media times of the runs, built
+        on first use."""
+        if getattr(self, '_index', None) is None:
+            self._index = build_sctts_index(self.table)
+        return self._index
+
     def write(self, fobj):
-        self.write_head(fobj)
-        write_ulong(fobj, len(self.table))
-        for elt in self.table:
-            write_ulong(fobj, elt[0])
-            write_ulong(fobj, elt[1])
+        self.write_table(fobj, 'LL')
 
 class ctts(FullBox):
     _fields = ('table',)
@@ -432,12 +660,14 @@ class ctts(FullBox):
     def get_size(self):
         return self.tabled_size(4, 8)
 
+    def get_index(self):
+        """Cumulative sample numbers of the runs, built on first use."""
+        if getattr(self, '_index', None) is None:
+            self._index = build_sctts_index(self.table, with_times=False)
+        return self._index
+
     def write(self, fobj):
-        self.write_head(fobj)
-        write_ulong(fobj, len(self.table))
-        for elt in self.table:
-            write_ulong(fobj, elt[0])
-            write_ulong(fobj, elt[1])
+        self.write_table(fobj, 'LL')
 
 class stss(FullBox):
     _fields = ('table',)
@@ -453,10 +683,7 @@ class stss(FullBox):
         return self.tabled_size(4, 4)
 
     def write(self, fobj):
-        self.write_head(fobj)
-        write_ulong(fobj, len(self.table))
-        for elt in self.table:
-            write_ulong(fobj, elt)
+        self.write_table(fobj, 'L')
 
 class stsz(FullBox):
     _fields = ('sample_size', 'table')
@@ -469,7 +696,7 @@ class stsz(FullBox):
         if ss == 0:
             t = read_table(a.f, 'L', entries)
         else:
-            t = []
+            t = new_table(U32)
         return cls(a, sample_size=ss, table=t)
 
     def get_size(self):
@@ -478,12 +705,7 @@ class stsz(FullBox):
         return self.tabled_size(8, 4)
 
     def write(self, fobj):
-        self.write_head(fobj)
-        write_ulong(fobj, self.sample_size)
-        write_ulong(fobj, len(self.table))
-        if self.sample_size == 0:
-            for elt in self.table:
-                write_ulong(fobj, elt)
+        self.write_table(fobj, 'L', self.sample_size)
 
 class stsc(FullBox):
     _fields = ('table',)
@@ -499,13 +721,14 @@ class stsc(FullBox):
     def get_size(self):
         return self.tabled_size(4, 12)
 
+    def get_index(self):
+        """Cumulative sample numbers of the entries, built on first use."""
+        if getattr(self, '_index', None) is None:
+            self._index = build_stsc_index(self.table)
+        return self._index
+
     def write(self, fobj):
-        self.write_head(fobj)
-        write_ulong(fobj, len(self.table))
-        for elt in self.table:
-            write_ulong(fobj, elt[0])
-            write_ulong(fobj, elt[1])
-            write_ulong(fobj, elt[2])
+        self.write_table(fobj, 'LLL')
 
 class stco(FullBox):
     _fields = ('table',)
@@ -521,10 +744,7 @@ class stco(FullBox):
         return self.tabled_size(4, 4)
 
     def write(self, fobj):
-        self.write_head(fobj)
-        write_ulong(fobj, len(self.table))
-        for elt in self.table:
-            write_ulong(fobj, elt)
+        self.write_table(fobj, 'L')
 
 class co64(FullBox):
     _fields = ('table',)
@@ -540,10 +760,7 @@ class co64(FullBox):
         return self.tabled_size(4, 8)
 
     def write(self, fobj):
-        self.write_head(fobj)
-        write_ulong(fobj, len(self.table))
-        for elt in self.table:
-            write_ulonglong(fobj, elt)
+        self.write_table(fobj, 'Q')
 
 class stz2(FullBox):
     _fields = ('field_size', 'table')
@@ -554,54 +771,82 @@ class stz2(FullBox):
         field_size = read_ulong(a.f) & 0xff
         entries = read_ulong(a.f)
 
-        def read_2u4(f):
-            b = read_bytes(f, 1)
-            return (b >> 4) & 0x0f, b & 0x0f
-        def flatten(l):
-            ret = []
-            for elt in l:
-                ret.extend(elt)
-            return ret
         if field_size == 16:
             t = read_table(a.f, 'H', entries)
         elif field_size == 8:
             t = read_table(a.f, 'B', entries)
         elif field_size == 4:
-            t = flatten([read_2u4(a.f) for _ in xrange((entries + 1) / 2)])
+            t = vector.unpack_nibbles(atoms.read_view(a.f, (entries + 1) // 2),
+                                      entries)
         else:
-            raise FormatError()
+            raise FormatError('Invalid "stz2" field size: %d' % field_size)
         return cls(a, field_size=field_size, table=t)
 
     def get_size(self):
-        fs = self.field_size / 8.0
-        return int(self.tabled_size(8, fs))
+        return (self._atom.head_size_ext() + 8 +
+                (len(self.table) * self.field_size + 7) // 8)
 
     def write(self, fobj):
-        self.write_head(fobj)
-        write_ulong(fobj, self.field_size & 0xff)
-        write_ulong(fobj, len(self.table))
-
-        def write_u16(f, n):
-            fobj.write(struct.pack('>H', n))
-        def write_u8(f, n):
-            fobj.write(struct.pack('B', n))
-        def write_2u4(f, n, m):
-            fobj.write(struct.pack('B', ((n & 0x0f) << 4) | (m & 0x0f)))
-        if field_size == 16:
-            for elt in self.table:
-                write_u16(fobj, elt)
-        elif field_size == 8:
-            for elt in self.table:
-                write_u8(fobj, elt)
-        elif field_size == 4:
-            for elt in takeby(self.table, 2):
-                write_2u4(fobj, *elt)
+        if self.field_size == 16:
+            data = pack_table(self.table, 'H')
+        elif self.field_size == 8:
+            data = pack_table(self.table, 'B')
+        elif self.field_size == 4:
+            data = vector.pack_nibbles(self.table)
         else:
-            raise FormatError()
+            raise FormatError('Invalid "stz2" field size: %d' %
+                              self.field_size)
+        fobj.write(self.head_data() +
+                   struct.pack('>LL', self.field_size & 0xff,
+                               len(self.table)))
+        fobj.write(data)
+
+def stz2_field_size(sizes):
+    """Returns the smallest 'stz2' field size fitting all the given
+    sample sizes, None if some need more than 16 bits."""
+    largest = vector.maximum(sizes)
+    for field_size in (4, 8, 16):
+        if largest >> field_size == 0:
+            return field_size
+    return None
+
+def compact_trak(atrak):
+    """Returns a copy of atrak with its 'stsz' box replaced by the
+    narrowest 'stz2' box holding the same sample sizes - or atrak
+    itself, if there is no such box (all the samples being of the same
+    size, or some of them too big)."""
+    stbl = atrak.mdia.minf.stbl
+    astsz = stbl.stsz
+    if astsz is None or astsz.sample_size != 0:
+        return atrak
+    field_size = stz2_field_size(astsz.table)
+    if field_size is None:
+        return atrak
+
+    a = astsz._atom
+    # takes the place of the 'stsz' atom in the output
+    new_atom = atoms.FullAtom(0, 'stz2', a.offset, 0, 0, a.f)
+    new_stz2 = stz2(new_atom, field_size=field_size,
+                    table=array(field_size == 16 and 'H' or 'B',
+                                astsz.table))
+    new_stbl = stbl.copy(stsz=None, stz2=new_stz2)
+    new_minf = atrak.mdia.minf.copy(stbl=new_stbl)
+    new_mdia = atrak.mdia.copy(minf=new_minf)
+    return atrak.copy(mdia=new_mdia)
+
+def compact_moov(amoov):
+    """Returns a copy of amoov with the sample sizes of its traks
+    stored in 'stz2' boxes where possible, see L{compact_trak}."""
+    return amoov.copy(trak=map(compact_trak, amoov.trak))
 
 class stbl(ContainerBox):
     _fields = ('stss', 'stsz', 'stz2', 'stco', 'co64', 'stts', 'ctts', 'stsc')
 
+    # the tables are parsed only when actually needed
+    stss, stsz, stz2 = lazybox('stss'), lazybox('stsz'), lazybox('stz2')
+    stco, co64 = lazybox('stco'), lazybox('co64')
+    stts, ctts, stsc = lazybox('stts'), lazybox('ctts'), lazybox('stsc')
+
     @classmethod
     @containerboxread
     def read(cls, a):
@@ -609,7 +854,8 @@ class stbl(ContainerBox):
             select_children_atoms(a, ('stss', 0, 1), ('stsz', 0, 1),
                                   ('stz2', 0, 1), ('stco', 0, 1),
                                   ('co64', 0, 1), ('stts', 1, 1),
-                                  ('ctts', 0, 1), ('stsc', 1, 1))
+                                  ('ctts', 0, 1), ('stsc', 1, 1),
+                                  build=False)
         return cls(a, stss=astss, stsz=astsz, stz2=astz2, stco=astco,
                    co64=aco64, stts=astts, ctts=actts, stsc=astsc)
 
@@ -652,6 +898,12 @@ class moov(ContainerBox):
                                                ('trak', 1, None))
         return cls(a, mvhd=amvhd, trak=traks)
 
+    def get_sync_index(self):
+        """The L{SyncIndex} of the traks, built on first use."""
+        if getattr(self, '_sync_index', None) is None:
+            self._sync_index = SyncIndex(self)
+        return self._sync_index
+
 class ftyp(Box):
     _fields = ('brand', 'version')
 
@@ -663,16 +915,78 @@ class ftyp(Box):
         return cls(a, brand=brand, version=v)
 
 def read_iso_file(fobj):
+    """Parse the top-level structure of a file.
+
+    The atoms of fragmented files are walked up to the first 'moof'
+    atom only - the fragments are looked at by L{fmp4} when needed.
+
+    @returns: ftyp box, moov box and list of top-level atoms
+    """
+    fobj = observe.wrap(fobj)
     fobj.seek(0)
 
-    al = list(atoms.read_atoms(fobj))
+    started = observe.clock()
+    al = []
+    for a in atoms.read_atoms(fobj):
+        al.append(a)
+        if a.type == 'moof':
+            break
+    observe.phase('walk', started)
+
+    started = observe.clock()
     ad = atoms.atoms_dict(al)
     aftyp, amoov, mdat = select_atoms(ad, ('ftyp', 1, 1), ('moov', 1, 1),
-                                      ('mdat', 1, None))
+                                      ('mdat', 'moof' not in ad and 1 or 0,
+                                       None))
+    observe.phase('parse', started)
     # print '(first mdat offset: %d)' % mdat[0].offset
 
     return aftyp, amoov, al
 
+def load_iso_file(fobj, index=None):
+    """Same as L{read_iso_file}, but takes the parsed structure from the
+    installed in-process cache (see L{cache}) or from a seek index (see
+    L{sidecar}) instead of parsing fobj, when possible.
+
+    @param index: seek index of the file to use, looked up next to the
+                  file (or in L{sidecar.INDEX_DIR}) if not given
+    @type  index: L{sidecar.SeekIndex}
+
+    @returns: ftyp box, moov box, list of top-level atoms and the
+              L{SyncIndex} of the moov (None, if not known up front)
+    """
+    import cache
+    fobj = observe.wrap(fobj)
+    moov_cache = cache.installed()
+    key = None
+    if moov_cache is not None:
+        key = cache.file_key(fobj)
+        if key is not None:
+            started = observe.clock()
+            loaded = moov_cache.get(key, fobj)
+            if loaded is not None:
+                observe.phase('load', started)
+                return loaded
+
+    if index is None:
+        import sidecar
+        index = sidecar.find_index(fobj)
+    if index is not None:
+        started = observe.clock()
+        loaded = index.bind(fobj)
+        observe.phase('load', started)
+    else:
+        aftyp, amoov, alist = read_iso_file(fobj)
+        loaded = aftyp, amoov, alist, None
+
+    if key is not None:
+        aftyp, amoov, alist, syncs = loaded
+        if syncs is None:
+            syncs = amoov.get_sync_index()
+        loaded = aftyp, amoov, alist, syncs
+        moov_cache.put(key, *loaded)
+    return loaded
+
 def find_cut_trak_info(atrak, t):
     ts = atrak.mdia.mdhd.timescale
     stbl = atrak.mdia.minf.stbl
@@ -680,8 +994,9 @@ def find_cut_trak_info(atrak, t):
     # print 'media time:', mt, t, ts, t * ts
     # print ('finding cut for trak %r @ time %r (%r/%r)' %
     #        (atrak._atom, t, mt, ts))
-    sample = find_samplenum_stts(stbl.stts.table, mt)
-    chunk = find_chunknum_stsc(stbl.stsc.table, sample)
+    sample = find_samplenum_stts(stbl.stts.table, mt, stbl.stts.get_index())
+    chunk = find_chunknum_stsc(stbl.stsc.table, sample,
+                               stbl.stsc.get_index())
     # print ('found sample: %d and chunk: %d/%r' %
     #        (sample, chunk, stbl.stsc.table[-1]))
     stco64 = stbl.stco or stbl.co64
@@ -691,30 +1006,29 @@ def find_cut_trak_info(atrak, t):
     return sample, chunk, zero_offset, chunk_offset
 
 def cut_stco64(stco64, chunk_num, offset_change, first_chunk_delta=0):
-    new_table = [offset - offset_change for offset in stco64[chunk_num - 1:]]
-    if new_table and first_chunk_delta:
-        new_table[0] = new_table[0] + first_chunk_delta
-    return new_table
-
-def cut_stco64_stsc(stco64, stsc, stsz2, chunk_num, sample_num, offset_change):
-    new_stsc = None
-
-    i, n = 0, len(stsc)
-    current, per_chunk, sdidx = 1, 0, None
-    samples = 1
-    while i < n:
-        next, next_per_chunk, next_sdidx = stsc[i]
-        if next > chunk_num:
-            offset = chunk_num - 1
-            new_stsc = ([(1, per_chunk, sdidx)]
-                        + [(c - offset, p_c, j)
-                           for (c, p_c, j) in stsc[i:]])
-            break
-        samples += (next - current) * per_chunk
-        current, per_chunk, sdidx = next, next_per_chunk, next_sdidx
-        i += 1
-    if new_stsc is None:
-        new_stsc = [(1, per_chunk, sdidx)]
+    new_stco64 = stco64[chunk_num - 1:]
+    if offset_change:
+        new_stco64 = vector.add(new_stco64, -offset_change)
+    if new_stco64 and first_chunk_delta:
+        new_stco64[0] = new_stco64[0] + first_chunk_delta
+    return new_stco64
+
+def cut_stco64_stsc(stco64, stsc, stsz2, chunk_num, sample_num, offset_change,
+                    index=None):
+    if index is None:
+        index = build_stsc_index(stsc)
+
+    firsts, per_chunks, sdidxs = stsc.columns
+    n = len(stsc)
+    i = bisect_right(firsts, chunk_num)
+    j = max(i - 1, 0)
+    samples, per_chunk, sdidx = index[j], per_chunks[j], sdidxs[j]
+
+    new_stsc = Table.from_rows([(1, per_chunk, sdidx)], stsc.typecodes())
+    if i < n:
+        rest = stsc[i:]
+        rest.columns[0] = vector.add(rest.columns[0], 1 - chunk_num)
+        new_stsc.extend(rest)
 
     lead_samples = (sample_num - samples) % per_chunk
 
@@ -728,47 +1042,42 @@ def cut_stco64_stsc(stco64, stsc, stsz2, chunk_num, sample_num, offset_change):
         fstsc = new_stsc[0]
         new_fstsc = (1, fstsc[1] - lead_samples, fstsc[2])
         # print 'old stsc', new_stsc
-        if len(new_stsc) > 1 and new_stsc[1][0] == 2:
+        if len(new_stsc) > 1 and new_stsc.columns[0][1] == 2:
             new_stsc[0] = new_fstsc
         else:
-            new_stsc[0:1] = [new_fstsc, (2, fstsc[1], fstsc[2])]
+            new_stsc[0] = new_fstsc
+            new_stsc.insert(1, (2, fstsc[1], fstsc[2]))
         # print 'new stsc', new_stsc
 
     return (cut_stco64(stco64, chunk_num, offset_change, bytes_offset),
             new_stsc)
 
-def cut_sctts(sctts, sample):
-    samples = 1
-    i, n = 0, len(sctts)
-    while i < n:
-        count, delta = sctts[i]
-        if samples + count > sample:
-            return [(samples + count - sample, delta)] + sctts[i+1:]
-        samples += count
-        i += 1
-    return []                   # ? :/
+def cut_sctts(sctts, sample, index=None):
+    if index is None:
+        index = build_sctts_index(sctts, with_times=False)
+    starts = index[0]
+    n = len(sctts)
+    i = bisect_right(starts, sample, 1) - 1
+    if i >= n:
+        return sctts[n:]                   # ? :/
+    new_sctts = sctts[i:]
+    new_sctts.columns[0][0] = starts[i + 1] - sample
+    return new_sctts
 
 def cut_stss(stss, sample):
-    i, n = 0, len(stss)
-    while i < n:
-        snum = stss[i]
-        # print 'cut_stss:', snum, sample
-        if snum >= sample:
-            return [s - sample + 1 for s in stss[i:]]
-        i += 1
-    return []
+    i = bisect_left(stss, sample)
+    return vector.add(stss[i:], 1 - sample)
 
 def cut_stsz2(stsz2, sample):
-    if not stsz2:
-        return []
     return stsz2[sample - 1:]
 
 def cut_trak(atrak, sample, data_offset_change):
     stbl = atrak.mdia.minf.stbl
-    chunk = find_chunknum_stsc(stbl.stsc.table, sample)
+    chunk = find_chunknum_stsc(stbl.stsc.table, sample, stbl.stsc.get_index())
     # print ('cutting trak: %r @ sample %d [chnk %d]' %
     #        (atrak._atom, sample, chunk))
-    media_time_diff = find_mediatime_stts(stbl.stts.table, sample) # - 0
+    media_time_diff = find_mediatime_stts(stbl.stts.table, sample,
+                                          stbl.stts.get_index()) # - 0
     new_media_duration = atrak.mdia.mdhd.duration - media_time_diff
 
     
@@ -786,7 +1095,8 @@ def cut_trak(atrak, sample, data_offset_change):
 
     new_stco64_t, new_stsc_t = cut_stco64_stsc(stco64.table, stbl.stsc.table,
                                                stsz2.table, chunk, sample,
-                                               data_offset_change)
+                                               data_offset_change,
+                                               stbl.stsc.get_index())
 
     new_stco64 = stco64.copy(table=new_stco64_t)
 
@@ -794,11 +1104,13 @@ def cut_trak(atrak, sample, data_offset_change):
 
     new_stsz2 = stsz2.copy(table=cut_stsz2(stsz2.table, sample))
 
-    new_stts = stbl.stts.copy(table=cut_sctts(stbl.stts.table, sample))
+    new_stts = stbl.stts.copy(table=cut_sctts(stbl.stts.table, sample,
+                                              stbl.stts.get_index()))
 
     new_ctts = None
     if stbl.ctts:
-        new_ctts = stbl.ctts.copy(table=cut_sctts(stbl.ctts.table, sample))
+        new_ctts = stbl.ctts.copy(table=cut_sctts(stbl.ctts.table, sample,
+                                                  stbl.ctts.get_index()))
 
     new_stss = None
     if stbl.stss:
@@ -831,6 +1143,98 @@ def cut_trak(atrak, sample, data_offset_change):
 
     return new_trak
 
+def clip_sctts(sctts, sample, index=None):
+    # keep the samples up to (and including) sample
+    if index is None:
+        index = build_sctts_index(sctts, with_times=False)
+    starts = index[0]
+    i = bisect_right(starts, sample, 1) - 1
+    if i >= len(sctts):
+        return sctts[:]
+    new_sctts = sctts[:i + 1]
+    new_sctts.columns[0][i] = sample - starts[i] + 1
+    return new_sctts
+
+def clip_stss(stss, sample):
+    return stss[:bisect_right(stss, sample)]
+
+def clip_stsz2(stsz2, sample):
+    return stsz2[:sample]
+
+def clip_stco64_stsc(stco64, stsc, stsz2, sample_num, sample_size=0,
+                     index=None):
+    """Truncate the chunk tables after the chunk holding sample_num.
+
+    @returns: new 'stco'/'co64' and 'stsc' tables, and the offset at
+              which the data of sample_num ends
+    """
+    if index is None:
+        index = build_stsc_index(stsc)
+
+    firsts, per_chunks, sdidxs = stsc.columns
+    chunk = find_chunknum_stsc(stsc, sample_num, index)
+    j = max(bisect_right(firsts, chunk) - 1, 0)
+    first_sample = index[j] + (chunk - firsts[j]) * per_chunks[j]
+    kept = sample_num - first_sample + 1
+
+    new_stsc = stsc[:j + 1]
+    if kept < per_chunks[j]:
+        # the last chunk is only partially kept
+        if firsts[j] == chunk:
+            new_stsc[j] = (chunk, kept, sdidxs[j])
+        else:
+            new_stsc.insert(j + 1, (chunk, kept, sdidxs[j]))
+
+    if sample_size:
+        data_size = kept * sample_size
+    else:
+        data_size = sum(stsz2[first_sample - 1:sample_num])
+
+    return (stco64[:chunk], new_stsc,
+            get_chunk_offset(stco64, chunk) + data_size)
+
+def clip_trak(atrak, mt):
+    """Remove the samples starting at or after the media time mt from
+    a trak cut with L{cut_trak} (with its chunk offsets not updated).
+
+    @returns: the new trak and the end offset of its data in the file
+    """
+    stbl = atrak.mdia.minf.stbl
+    stts_index = stbl.stts.get_index()
+    total = stts_index[0][-1] - 1
+    sample = find_samplenum_stts(stbl.stts.table, mt, stts_index) - 1
+    sample = int(max(min(sample, total), 1))
+
+    stco64 = stbl.stco or stbl.co64
+    stsz2 = stbl.stsz or stbl.stz2
+    new_stco64_t, new_stsc_t, data_end = \
+        clip_stco64_stsc(stco64.table, stbl.stsc.table, stsz2.table, sample,
+                         getattr(stsz2, 'sample_size', 0),
+                         stbl.stsc.get_index())
+
+    new_stts = stbl.stts.copy(table=clip_sctts(stbl.stts.table, sample,
+                                               stts_index))
+    stbl_attribs = dict(stts=new_stts,
+                        stsc=stbl.stsc.copy(table=new_stsc_t))
+    stbl_attribs[stbl.stco and 'stco' or 'co64'] = \
+        stco64.copy(table=new_stco64_t)
+    stbl_attribs[stbl.stsz and 'stsz' or 'stz2'] = \
+        stsz2.copy(table=clip_stsz2(stsz2.table, sample))
+    if stbl.ctts:
+        stbl_attribs['ctts'] = stbl.ctts.copy(
+            table=clip_sctts(stbl.ctts.table, sample, stbl.ctts.get_index()))
+    if stbl.stss:
+        stbl_attribs['stss'] = stbl.stss.copy(
+            table=clip_stss(stbl.stss.table, sample))
+
+    new_stbl = stbl.copy(**stbl_attribs)
+    new_minf = atrak.mdia.minf.copy(stbl=new_stbl)
+    new_mdhd = atrak.mdia.mdhd.copy(duration=new_stts.get_index()[1][-1])
+    new_mdia = atrak.mdia.copy(mdhd=new_mdhd, minf=new_minf)
+    new_trak = atrak.copy(tkhd=atrak.tkhd.copy(), mdia=new_mdia)
+
+    return new_trak, data_end
+
 def update_offsets(atrak, data_offset_change):
     """
     cut_stco64(stco64, 1, ...)  # again, after calculating new size of moov
@@ -847,7 +1251,52 @@ def update_offsets(atrak, data_offset_change):
     # print atrak
     # print
 
-def cut_moov(amoov, t):
+def cut_moov(amoov, t, moov_first=True, compact=False):
+    """
+    @param moov_first: whether the 'moov' atom precedes the media data
+                       - otherwise it is assumed to be moved in front
+                       of it in the output
+    @type  moov_first: bool
+
+    @param compact: whether to store the sample sizes in the smallest
+                    boxes possible, see L{compact_trak}
+    @type  compact: bool
+    """
+    return _cut_moov(amoov, t, moov_first, compact=compact)[:3]
+
+def clip_moov(amoov, t, end_t, moov_first=True, head_size=8, compact=False):
+    """Like L{cut_moov}, but also removes the samples following end_t
+    (cutting at the first sample boundary after it). The chunk offsets
+    are updated for the clipped data to be placed in a single new
+    'mdat' atom, see L{write_clip_header}.
+
+    @param head_size: header size of the first 'mdat' atom
+    @type  head_size: int
+
+    @returns: new moov box and the range of the data (start, end) to
+              place in the new 'mdat'
+
+    @raise ValueError: if end_t doesn't follow t
+    """
+    check_clip(t, end_t)
+    new_moov, delta, start, end = _cut_moov(amoov, t, moov_first, end_t,
+                                            head_size, compact)
+    return new_moov, start, end
+
+def check_clip(t, end_t):
+    "Raises ValueError unless the clip end end_t (or None) follows t."
+    if end_t is not None and end_t <= t:
+        raise ValueError('Clip end %r not after its start %r' % (end_t, t))
+
+def mdat_head_size(data_size):
+    "Returns the size of the header of an 'mdat' with data_size bytes."
+    if data_size + 8 > 0xffffffffL:
+        return 16
+    return 8
+
+def _cut_moov(amoov, t, moov_first=True, end_t=None, head_size=8,
+              compact=False):
+    started = observe.clock()
     ts = amoov.mvhd.timescale
     duration = amoov.mvhd.duration
     if t * ts >= duration:
@@ -863,13 +1312,30 @@ def cut_moov(amoov, t):
     # print 'new offset: %d, delta: %d' % (new_data_offset,
     #                                      new_data_offset - zero_offset)
 
-    new_traks = map(lambda a, ci: cut_trak(a, ci[0],
-                                           new_data_offset - zero_offset),
-                    traks, cut_info)
-
-    new_moov = amoov.copy(mvhd=amoov.mvhd.copy(), trak=new_traks)
-
-    moov_size_diff = amoov.get_size() - new_moov.get_size()
+    # the chunk offsets are shifted only once, below, when the size of
+    # the new moov is known
+    new_traks = map(lambda a, ci: cut_trak(a, ci[0], 0), traks, cut_info)
+
+    data_end = None
+    head_size_diff = 0
+    new_mvhd = amoov.mvhd.copy()
+    if end_t is not None:
+        clipped = [clip_trak(a, int(round(end_t * a.mdia.mdhd.timescale)) -
+                             (oa.mdia.mdhd.duration - a.mdia.mdhd.duration))
+                   for a, oa in zip(new_traks, traks)]
+        new_traks = [c[0] for c in clipped]
+        data_end = max([c[1] for c in clipped])
+        head_size_diff = head_size - mdat_head_size(data_end -
+                                                    new_data_offset)
+    if compact:
+        new_traks = map(compact_trak, new_traks)
+
+    new_moov = amoov.copy(mvhd=new_mvhd, trak=new_traks)
+
+    if moov_first:
+        moov_size_diff = amoov.get_size() - new_moov.get_size()
+    else:
+        moov_size_diff = - new_moov.get_size()
     # print ('moov_size_diff', moov_size_diff, amoov.get_size(),
     #        new_moov.get_size())
     # print 'real moov sizes', amoov._atom.size, new_moov._atom.size
@@ -884,20 +1350,82 @@ def cut_moov(amoov, t):
     # print
 
     map(update_trak_duration, new_traks)
-    map(lambda a: update_offsets(a, moov_size_diff), new_traks)
+    if end_t is not None:
+        new_mvhd.duration = max([a.tkhd.duration for a in new_traks])
+    map(lambda a: update_offsets(a, new_data_offset - zero_offset +
+                                 moov_size_diff + head_size_diff), new_traks)
 
-    return new_moov, new_data_offset - zero_offset, new_data_offset
+    observer = observe.installed()
+    if observer is not None:
+        observe.phase('cut', started)
+        for i, atrak in enumerate(traks):
+            observer.tables(i, table_sizes(atrak))
 
+    return new_moov, new_data_offset - zero_offset, new_data_offset, data_end
 
-def split_atoms(f, out_f, t):
-    aftype, amoov, alist = read_iso_file(f)
-    t = find_nearest_syncpoint(amoov, t)
-    # print 'nearest syncpoint:', t
-    nmoov, delta, new_offset = cut_moov(amoov, t)
 
+def table_sizes(atrak):
+    """Returns the number of entries of the (parsed) sample tables of
+    atrak, by box type."""
+    stbl = atrak.mdia.minf.stbl
+    sizes = {}
+    for k in stbl._fields:
+        abox = stbl.get_raw(k)
+        if isinstance(abox, Box) and hasattr(abox, 'table'):
+            sizes[k] = len(abox.table)
+    return sizes
+
+def split_atoms_range(f, out_f, t, index=None, end_t=None, compact=False):
+    """Write the header of the split file to out_f.
+
+    @param end_t: end of the clip, in seconds - up to the end of the
+                  file if None
+    @type  end_t: float
+
+    @returns: range of the data of the original file (start, end) to
+              follow the header, end being None for the end of the file
+    @rtype:   tuple
+    """
+    aftype, amoov, alist, syncs = load_iso_file(f, index)
+    return _split_loaded(out_f, amoov, alist, syncs, t, end_t, compact)
+
+def _split_loaded(out_f, amoov, alist, syncs, t, end_t=None, compact=False):
+    check_clip(t, end_t)
+    if alist[-1].type == 'moof':
+        import fmp4
+        return fmp4.split_fragments(out_f, amoov, alist, t, end_t)
+
+    t = find_nearest_syncpoint(amoov, t, syncs)
+    # print 'nearest syncpoint:', t
+    moov_idx = find_atom(alist, 'moov')
+    mdat_idx = find_atom(alist, 'mdat')
+    moov_first = moov_idx < mdat_idx
+
+    if end_t is not None:
+        # not clip_moov: t may have moved past end_t, to the sync point
+        nmoov, delta, start, end = _cut_moov(amoov, t, moov_first, end_t,
+                                             alist[mdat_idx].head_size(),
+                                             compact)
+        started = observe.clock()
+        write_clip_header(out_f, nmoov, alist, end - start)
+        observe.phase('write_header', started)
+        return start, end
+
+    nmoov, delta, new_offset = cut_moov(amoov, t, moov_first, compact)
+
+    end = None
+    if not moov_first:
+        # the new header goes in front, the data ends before the old one
+        end = alist[moov_idx].offset
+
+    started = observe.clock()
     write_split_header(out_f, nmoov, alist, delta)
+    observe.phase('write_header', started)
 
-    return new_offset
+    return new_offset, end
+
+def split_atoms(f, out_f, t, index=None):
+    return split_atoms_range(f, out_f, t, index)[0]
 
 def update_mdat_atoms(alist, size_delta):
     updated = []
@@ -923,6 +1451,10 @@ def write_split_header(out_f, amoov, alist, size_delta):
     mdat_idx = find_atom(alist, 'mdat')
 
     mdat = alist[mdat_idx]
+    if moov_idx > mdat_idx:
+        # write the 'moov' in front of the media data
+        alist = alist[:mdat_idx] + [alist[moov_idx]] + alist[mdat_idx:]
+        moov_idx, mdat_idx = mdat_idx, mdat_idx + 1
 
     cut_offset = mdat.offset + mdat.head_size() + size_delta
     to_update = [a for a in alist[mdat_idx:] if a.offset < cut_offset]
@@ -942,58 +1474,291 @@ def write_split_header(out_f, amoov, alist, size_delta):
         if a.real_size == 1:
             write_ulonglong(out_f, a.size)
 
-def split(f, t, out_f=None):
+def write_clip_header(out_f, amoov, alist, data_size):
+    """Write the top-level atoms preceding the media data, with amoov
+    in place of the original 'moov', followed by the header of a single
+    'mdat' atom holding data_size bytes."""
+    mdat_idx = find_atom(alist, 'mdat')
+    head = [a for a in alist[:mdat_idx] if a.type != 'moov']
+    head.insert(min(find_atom(alist, 'moov'), mdat_idx), amoov)
+    write_atoms(head, out_f)
+
+    if mdat_head_size(data_size) == 8:
+        write_ulong(out_f, data_size + 8)
+        write_fcc(out_f, 'mdat')
+    else:
+        write_ulong(out_f, 1)
+        write_fcc(out_f, 'mdat')
+        write_ulonglong(out_f, data_size + 16)
+
+def split_range(f, t, out_f=None, index=None, end_t=None, compact=False):
+    """Like L{split}, but also returns where the data to copy from the
+    original file ends - None for the end of the file. Files with the
+    'moov' atom following the media data can only be split this way,
+    as well as clips with an end time.
+
+    @param end_t: end of the clip, in seconds - the media gets cut at
+                  the first sample boundary following it
+    @type  end_t: float
+
+    @raise ValueError: if end_t doesn't follow t
+
+    @param compact: whether to store the sample sizes in the smallest
+                    boxes possible, see L{compact_trak}
+    @type  compact: bool
+    """
     wf = out_f
     if wf is None:
         from cStringIO import StringIO
         wf = StringIO()
 
-    new_offset = split_atoms(f, wf, t)
+    start, end = split_atoms_range(f, wf, t, index, end_t, compact)
+    return wf, start, end
+
+def split(f, t, out_f=None, index=None, compact=False):
+    wf, new_offset, end = split_range(f, t, out_f, index, compact=compact)
     return wf, new_offset
 
-def split_and_write(in_f, out_f, t):
-    header_f, new_offset = split(in_f, t)
+def split_many(f, times, out_fs=None, index=None, end_times=None,
+               compact=False):
+    """Split a file at many points, parsing it only once - the sync
+    points and the lookup indexes of the sample tables are shared by
+    all the cuts.
+
+    @param times: split points, in seconds
+    @type  times: list
+
+    @param out_fs: files to write the headers to, one for each split
+                   point - new StringIO objects if None
+    @type  out_fs: list
+
+    @param end_times: clip end for each split point (see L{split_range}),
+                      None for no clipping
+    @type  end_times: list
+
+    @returns: the same as L{split_range}, for each split point
+    @rtype:   list
+    """
+    if out_fs is None:
+        from cStringIO import StringIO
+        out_fs = [StringIO() for t in times]
+    if len(out_fs) != len(times):
+        raise ValueError('Number of output files different from the'
+                         ' number of split points')
+    if end_times is None:
+        end_times = [None] * len(times)
+    if len(end_times) != len(times):
+        raise ValueError('Number of clip ends different from the number'
+                         ' of split points')
+
+    aftype, amoov, alist, syncs = load_iso_file(f, index)
+    results = []
+    for t, end_t, wf in zip(times, end_times, out_fs):
+        # writing the header replaces the 'moov' in alist
+        start, end = _split_loaded(wf, amoov, list(alist), syncs, t, end_t,
+                                   compact)
+        results.append((wf, start, end))
+    return results
+
+def _write_split(in_f, out_f, header_f, start, end):
     header_f.seek(0)
     out_f.write(header_f.read())
-    in_f.seek(new_offset)
-    out_f.write(in_f.read())
+    count = None
+    if end is not None:
+        count = end - start
+    started = observe.clock()
+    copied = transfer.copy_range(in_f, out_f, start, count)
+    observer = observe.installed()
+    if observer is not None:
+        observe.phase('copy', started)
+        observer.copied(copied)
+
+def split_and_write(in_f, out_f, t, end_t=None, compact=False):
+    header_f, new_offset, end = split_range(in_f, t, end_t=end_t,
+                                            compact=compact)
+    _write_split(in_f, out_f, header_f, new_offset, end)
+
+def split_many_and_write(in_f, out_fs, times, end_times=None,
+                         compact=False):
+    """Write the files split at each of the given points to out_fs."""
+    results = split_many(in_f, times, end_times=end_times, compact=compact)
+    for out_f, (header_f, start, end) in zip(out_fs, results):
+        _write_split(in_f, out_f, header_f, start, end)
 
 def main(f, t):
     split_and_write(f, file('/tmp/t.mp4', 'w'), t)
 
-def find_sync_points(amoov):
-    ts = amoov.mvhd.timescale
-    traks = amoov.trak
-    def find_sync_samples(a):
-        stbl = a.mdia.minf.stbl
+class SyncIndex(object):
+    """Sync points of all the traks of a 'moov' atom.
+
+    The sync points are kept as media times of the sync samples, in
+    the timescales of the traks - traks with no 'stss' table, in which
+    every sample is a sync sample, are looked up in their 'stts' table
+    directly. All the lookups are binary searches.
+
+    The times passed to and returned by the queries are in seconds;
+    the track argument is the index of the trak in 'moov', the
+    reference track (see L{reference}) if None.
+
+    @ivar timescales: timescales of the traks
+    @type timescales: list
+
+    @ivar tables: media times of the sync samples of each trak, None
+                  for the traks without 'stss'
+    @type tables: list
+
+    @ivar reference: index of the trak used by default - the first one
+                     with a non-empty 'stss' (ideally there's only one,
+                     from a video trak), None if there are none
+    @type reference: int or None
+    """
+
+    def __init__(self, amoov, tables=None):
+        """
+        @param tables: the sync sample times of the traks, as in
+                       L{tables} - found in amoov if None
+        @type  tables: list
+        """
+        traks = amoov.trak
+        self.timescales = [a.mdia.mdhd.timescale for a in traks]
+        if tables is None:
+            tables = map(self._find_sync_times, traks)
+        self.tables = tables
+        self._stts = [t is None and _stts_lookup(a) or None
+                      for a, t in zip(traks, tables)]
+        self.reference = None
+        for i, t in enumerate(tables):
+            if t:
+                self.reference = i
+                break
+
+    @staticmethod
+    def _find_sync_times(atrak):
+        stbl = atrak.mdia.minf.stbl
         if not stbl.stss:
-            return []
-        stss = stbl.stss
-        stts = stbl.stts.table
-        ts = float(a.mdia.mdhd.timescale)
-        return map(lambda mt: mt / ts, find_mediatimes(stts, stss.table))
-    sync_tables = [t for t in map(find_sync_samples, traks) if t]
-    if sync_tables:
-        # ideally there should be only one sync table (from a video
-        # trak) - an arbitrary one will be taken otherwise...
-        return sync_tables[0]
-    return []
-
-def find_nearest_syncpoint(amoov, t):
-    syncs = find_sync_points(amoov)
+            return None
+        stts = stbl.stts
+        return find_mediatimes(stts.table, stbl.stss.table, stts.get_index())
+
+    def __len__(self):
+        return len(self.tables)
+
+    def _track(self, track):
+        if track is None:
+            return self.reference or 0
+        return track
+
+    def _media_time(self, t, track):
+        mt = t * self.timescales[track]
+        if abs(mt - round(mt)) < 1e-6:
+            # a time returned by one of the queries
+            return int(round(mt))
+        return mt
+
+    def points(self, track=None):
+        """Returns the times of all the sync points of the track."""
+        track = self._track(track)
+        ts = float(self.timescales[track])
+        times = self.tables[track]
+        if times is None:
+            stts, index = self._stts[track]
+            times = find_mediatimes(stts, new_table(U64,
+                                                    xrange(1, index[0][-1])),
+                                    index)
+        return [mt / ts for mt in times]
+
+    def prev(self, t, track=None):
+        """Returns the time of the last sync point at or before t, None
+        if there is none."""
+        track = self._track(track)
+        mt = self._media_time(t, track)
+        times = self.tables[track]
+        if times is None:
+            stts, index = self._stts[track]
+            sample = max(find_samplenum_stts(stts, mt, index), 1)
+            if sample < index[0][-1] and \
+                    find_mediatime_stts(stts, sample, index) == mt:
+                found = mt
+            elif sample > 1:
+                found = find_mediatime_stts(stts, sample - 1, index)
+            else:
+                return None
+        else:
+            i = bisect_right(times, mt)
+            if not i:
+                return None
+            found = times[i - 1]
+        return found / float(self.timescales[track])
+
+    def next(self, t, track=None):
+        """Returns the time of the first sync point at or after t, None
+        if there is none."""
+        track = self._track(track)
+        mt = self._media_time(t, track)
+        times = self.tables[track]
+        if times is None:
+            stts, index = self._stts[track]
+            sample = max(find_samplenum_stts(stts, mt, index), 1)
+            if sample >= index[0][-1]:
+                return None
+            found = find_mediatime_stts(stts, sample, index)
+        else:
+            i = bisect_left(times, mt)
+            if i == len(times):
+                return None
+            found = times[i]
+        return found / float(self.timescales[track])
+
+    def nearest(self, t, track=None):
+        """Returns the time of the sync point nearest t (the following
+        one, if both are as near), None if the track has none."""
+        prev, next = self.prev(t, track), self.next(t, track)
+        if prev is None or (next is not None and next - t <= t - prev):
+            return next
+        return prev
+
+def _stts_lookup(atrak):
+    stts = atrak.mdia.minf.stbl.stts
+    return stts.table, stts.get_index()
+
+def load_sync_index(fobj, index=None):
+    """Returns the L{SyncIndex} of a file, loaded the same way as for
+    splitting it (see L{load_iso_file})."""
+    aftyp, amoov, alist, syncs = load_iso_file(fobj, index)
+    if syncs is None:
+        syncs = amoov.get_sync_index()
+    return syncs
+
+def find_sync_points(amoov):
+    syncs = amoov.get_sync_index()
+    if syncs.reference is None:
+        return []
+    return syncs.points()
+
+def find_nearest_syncpoint(amoov, t, syncs=None):
+    """
+    @param syncs: sync points of amoov, or a list of times of the sync
+                  points to choose from
+    @type  syncs: L{SyncIndex} or list
+    """
+    if syncs is None:
+        syncs = amoov.get_sync_index()
+    if isinstance(syncs, SyncIndex):
+        found = None
+        if syncs.reference is not None:
+            found = syncs.nearest(t)
+        if found is not None:
+            return found
+        syncs = []
 
     if not syncs:
         # hardcoding duration - 0.1 sec as the farthest seek pos for now...
         max_ts = amoov.mvhd.duration / float(amoov.mvhd.timescale) - 0.1
         return max(0, min(t, max_ts))
 
-    found = 0
-    other = 0
-    for ss in syncs:
-        if ss > t:
-            other = ss
-            break
-        found = ss
+    i = bisect_right(syncs, t)
+    found = i and syncs[i - 1] or 0
+    other = i < len(syncs) and syncs[i] or 0
     if (abs(t - found) < abs(other - t)):
         return found
     return other
@@ -1003,8 +1768,10 @@ def get_nearest_syncpoint(f, t):
     print find_nearest_syncpoint(amoov, t)
 
 def get_sync_points(f):
-    aftyp, amoov, alist = read_iso_file(f)
-    return find_sync_points(amoov)
+    syncs = load_sync_index(f)
+    if syncs.reference is None:
+        return []
+    return syncs.points()
 
 def get_debugging(f):
     aftyp, amoov, alist = read_iso_file(f)
@@ -1024,8 +1791,17 @@ def change_chunk_offsets(amoov, data_offset):
     # FIXME: make the offset direction sane in update_offsets...?
     map(lambda a: update_offsets(a, - data_offset), amoov.trak)
 
-def move_header_to_front(f):
-    aftype, amoov, alist = read_iso_file(f)
+def find_moov_placement(alist):
+    """Find where the 'moov' atom should be moved to, to precede the
+    media data.
+
+    @returns: current and new index of the 'moov' atom in alist, or
+              None if it is already in front of the media data
+    @rtype:   tuple or None
+    """
+    if alist[-1].type == 'moof':
+        # fragmented, 'moov' has to precede the fragments anyway
+        return None
 
     moov_idx = find_atom(alist, 'moov')
     mdat_idx = find_atom(alist, 'mdat')
@@ -1045,6 +1821,28 @@ def move_header_to_front(f):
                 new_moov_idx -= 1
                 break
 
+    return moov_idx, new_moov_idx
+
+def move_header_to_front(f, compact=False):
+    """
+    @param compact: whether to store the sample sizes in the smallest
+                    boxes possible, see L{compact_trak}
+    @type  compact: bool
+
+    @returns: the top-level atoms, with the 'moov' one moved, or None
+              if it is already in front of the media data
+    @rtype:   list or None
+    """
+    aftype, amoov, alist = read_iso_file(f)
+
+    placement = find_moov_placement(alist)
+    if placement is None:
+        return None
+    moov_idx, new_moov_idx = placement
+
+    if compact:
+        amoov = compact_moov(amoov)
+
     # for the moment assuming rewriting offsets in moov won't change
     # the atoms sizes - could happen if:
     #   2**32 - 1 - last_chunk_offset < moov.size
@@ -1057,10 +1855,18 @@ def move_header_to_front(f):
 
     return alist
 
-def move_header_and_write(in_f, out_f):
-    alist = move_header_to_front(in_f)
+def move_header_and_write(in_f, out_f, compact=False):
+    alist = move_header_to_front(in_f, compact)
     if alist:
+        started = observe.clock()
         write_atoms(alist, out_f)
+        observer = observe.installed()
+        if observer is not None:
+            observe.phase('copy', started)
+            # the media data, following the new 'moov', as in _write_split
+            moov_idx = [isinstance(a, moov) for a in alist].index(True)
+            observer.copied(sum([a.get_size()
+                                 for a in alist[moov_idx + 1:]]))
         return True
     return False
 
@@ -0,0 +1,260 @@
+"""Instrumentation of the parsing, cutting and writing of files.
+
+Once an L{Observer} is installed with L{install}, L{iso} (and L{async})
+report to it the durations of the processing phases, the reads and
+seeks made on the source files, the sizes of the sample tables of the
+cut traks and the data requests of L{async.Splitter}. Nothing is
+reported (nor measured) while no observer is installed.
+
+The phases reported are:
+
+  - 'walk': walking the top-level atoms of a file
+  - 'load': taking the parsed structure from the cache or a seek index
+  - 'parse': parsing a box (the sample tables are parsed lazily, on
+    first access - so this one usually happens within 'cut')
+  - 'cut': rewriting the 'moov' for a split point
+  - 'write_header': writing the new header
+  - 'copy': copying the media data to the output
+
+L{Stats} aggregates the reports into counters and histograms:
+
+    stats = observe.Stats()
+    observe.install(stats)
+    ...
+    print stats.snapshot()
+"""
+
+import math
+import threading
+import time
+
+
+class Observer(object):
+    """Base class of the observers, ignoring all the reports."""
+
+    def phase(self, name, seconds):
+        """A processing phase took the given number of seconds."""
+
+    def read(self, size):
+        """size bytes were read from a source file."""
+
+    def seek(self):
+        """A source file was seeked in."""
+
+    def copied(self, size):
+        """size bytes of media data were copied to the output."""
+
+    def tables(self, track, sizes):
+        """A trak was cut.
+
+        @param track: index of the trak in the 'moov'
+        @type  track: int
+
+        @param sizes: number of entries of the sample tables of the
+                      trak, by box type
+        @type  sizes: dict
+        """
+
+    def request(self, size, offset):
+        """L{async.Splitter} requested size bytes at offset."""
+
+
+_installed = None
+
+def install(observer):
+    """Report to the given L{Observer} (or stop reporting, if None)."""
+    global _installed
+    _installed = observer
+
+def installed():
+    return _installed
+
+
+def clock():
+    """Returns the start time of a phase, to be passed to L{phase} - or
+    None if no observer is installed."""
+    if _installed is None:
+        return None
+    return time.time()
+
+def phase(name, started):
+    """Report the end of a phase started at the time returned by
+    L{clock}."""
+    observer = _installed
+    if started is not None and observer is not None:
+        observer.phase(name, time.time() - started)
+
+
+class CountingFile(object):
+    """File object proxy reporting the reads and seeks to an observer.
+
+    The calls on the file object are counted, not the actual syscalls
+    - the buffering of the underlying file may merge some of them.
+    """
+
+    def __init__(self, fobj, observer):
+        self._fobj = fobj
+        self._observer = observer
+
+    def read(self, size=-1):
+        data = self._fobj.read(size)
+        self._observer.read(len(data))
+        return data
+
+    def seek(self, offset, whence=0):
+        self._observer.seek()
+        return self._fobj.seek(offset, whence)
+
+    def tell(self):
+        return self._fobj.tell()
+
+    def __getattr__(self, name):
+        return getattr(self._fobj, name)
+
+def wrap(fobj):
+    """Returns fobj wrapped in a L{CountingFile} reporting to the
+    installed observer - or fobj itself, if there is none."""
+    observer = _installed
+    if observer is None or isinstance(fobj, CountingFile):
+        return fobj
+    import atoms
+    if isinstance(fobj, atoms.MappedFile):
+        # reads from the mapping make no syscalls, and the atoms module
+        # needs to see the mapped file itself to use it
+        return fobj
+    return CountingFile(fobj, observer)
+
+
+class Histogram(object):
+    """Distribution of values, in power of two buckets."""
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        # upper bound exponent -> number of values
+        self._buckets = {}
+
+    def add(self, v):
+        self.count += 1
+        self.sum += v
+        if self.min is None or v < self.min:
+            self.min = v
+        if self.max is None or v > self.max:
+            self.max = v
+        e = None
+        if v > 0:
+            e = math.frexp(v)[1]
+        self._buckets[e] = self._buckets.get(e, 0) + 1
+
+    def percentile(self, p):
+        """Returns an upper bound of the p-th percentile of the values
+        (exact for the minimum and maximum), None if there are none."""
+        if not self.count:
+            return None
+        rank = max(int(math.ceil(self.count * p / 100.0)), 1)
+        seen = 0
+        for e, n in sorted(self._buckets.items()):
+            seen += n
+            if seen >= rank:
+                if e is None:
+                    return self.min
+                return max(min(math.ldexp(1, e), self.max), self.min)
+        return self.max
+
+    def summary(self):
+        return dict(count=self.count, sum=self.sum, min=self.min,
+                    max=self.max,
+                    mean=self.count and self.sum / float(self.count) or None,
+                    p50=self.percentile(50), p90=self.percentile(90),
+                    p99=self.percentile(99))
+
+
+class Stats(Observer):
+    """Observer aggregating the reports into counters and histograms.
+
+    Counters: reads, bytes_read, seeks, copies, bytes_copied, requests
+    and bytes_requested. Histograms: the phase durations ('phase.' and
+    the phase name), the sizes of the sample tables ('table.' and the
+    box type) and of the L{async.Splitter} requests ('request_size').
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self.counters = {}
+            self.histograms = {}
+        finally:
+            self._lock.release()
+
+    def _count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def _add(self, name, v):
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram()
+        h.add(v)
+
+    def phase(self, name, seconds):
+        self._lock.acquire()
+        try:
+            self._add('phase.' + name, seconds)
+        finally:
+            self._lock.release()
+
+    def read(self, size):
+        self._lock.acquire()
+        try:
+            self._count('reads')
+            self._count('bytes_read', size)
+        finally:
+            self._lock.release()
+
+    def seek(self):
+        self._lock.acquire()
+        try:
+            self._count('seeks')
+        finally:
+            self._lock.release()
+
+    def copied(self, size):
+        self._lock.acquire()
+        try:
+            self._count('copies')
+            self._count('bytes_copied', size)
+        finally:
+            self._lock.release()
+
+    def tables(self, track, sizes):
+        self._lock.acquire()
+        try:
+            for k, n in sizes.items():
+                self._add('table.' + k, n)
+        finally:
+            self._lock.release()
+
+    def request(self, size, offset):
+        self._lock.acquire()
+        try:
+            self._count('requests')
+            self._count('bytes_requested', size)
+            self._add('request_size', size)
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """Returns the current counters and the summaries of the
+        histograms, in a dictionary."""
+        self._lock.acquire()
+        try:
+            return dict(counters=dict(self.counters),
+                        histograms=dict([(k, h.summary()) for k, h in
+                                         self.histograms.items()]))
+        finally:
+            self._lock.release()
@@ -0,0 +1,322 @@
+"""Persistent seek index stored alongside the media files.
+
+The index holds the parsed 'moov' tree (with its sample tables), the
+top-level atoms layout and the sync points of a file, in a form that
+loads much faster than parsing the 'moov' atom again. It is tied to the
+file it was created from by its size, modification time and inode - a
+stale index is simply ignored.
+"""
+
+from array import array
+import marshal
+import os
+import struct
+import sys
+import tempfile
+
+import atoms
+import iso
+
+INDEX_SUFFIX = '.mp4seek'
+
+# directory to keep the index files in - next to the indexed files if None
+INDEX_DIR = None
+
+_MAGIC = 'mp4seek\0'
+_FORMAT = 3
+
+# magic, format, byte order, typecodes of the 32- and 64-bit arrays,
+# identity of the indexed file (size, mtime, inode) and size of the
+# marshalled data following the header - checked before loading any
+# of the data
+_HEADER = '>8sHcccQdQQ'
+_HEADER_SIZE = struct.calcsize(_HEADER)
+_ARRAYS = (sys.byteorder[0], iso.U32 or '-', iso.U64 or '-')
+
+_ATOM, _FULL_ATOM, _CONTAINER_ATOM = 0, 1, 2
+
+
+def file_identity(fobj):
+    """Returns (size, mtime, inode) of an open file, or None if fobj is
+    not backed by a real file."""
+    try:
+        st = os.fstat(fobj.fileno())
+    except (AttributeError, ValueError, OSError, IOError):
+        return None
+    return path_identity_from_stat(st)
+
+def path_identity(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return path_identity_from_stat(st)
+
+def path_identity_from_stat(st):
+    return (st.st_size, st.st_mtime, st.st_ino)
+
+def index_path(path, index_dir=None):
+    """Returns the path of the index file for the given media file."""
+    if index_dir is None:
+        index_dir = INDEX_DIR
+    if index_dir is None:
+        return path + INDEX_SUFFIX
+    try:
+        from hashlib import md5
+    except ImportError:
+        from md5 import md5
+    name = md5(os.path.abspath(path)).hexdigest()
+    return os.path.join(index_dir, name + INDEX_SUFFIX)
+
+
+def _dump_atom(a):
+    if isinstance(a, atoms.FullAtom):
+        return (_FULL_ATOM, a.size, a.type, a.offset, a.real_size,
+                a.v, a.flags)
+    if isinstance(a, atoms.ContainerAtom):
+        children = None
+        if a._children_dict is not None:
+            children = []
+            for alist in a._children_dict.values():
+                children.extend(alist)
+            children.sort(key=lambda ca: ca.offset)
+            children = [_dump_atom(ca) for ca in children]
+        return (_CONTAINER_ATOM, a.size, a.type, a.offset, a.real_size,
+                children)
+    return (_ATOM, a.size, a.type, a.offset, a.real_size)
+
+def _load_atom(d, fobj):
+    kind, size, type, offset, real_size = d[:5]
+    if kind == _FULL_ATOM:
+        return atoms.FullAtom(size, type, offset, d[5], d[6], fobj,
+                              real_size=real_size)
+    if kind == _CONTAINER_ATOM:
+        a = atoms.ContainerAtom(size, type, offset, fobj, real_size=real_size)
+        if d[5] is not None:
+            a._children = [_load_atom(cd, fobj) for cd in d[5]]
+            a._children_dict = atoms.atoms_dict(a._children)
+        return a
+    return atoms.Atom(size, type, offset, fobj, real_size=real_size)
+
+def _dump_value(v):
+    if isinstance(v, iso.Box):
+        return _dump_box(v)
+    if isinstance(v, atoms.Atom):
+        return ('atom', _dump_atom(v))
+    if isinstance(v, array):
+        return ('array', v.typecode, v.tostring())
+    if isinstance(v, iso.Table):
+        return ('table', [_dump_value(c) for c in v.columns])
+    if isinstance(v, list):
+        return ('list', [_dump_value(elt) for elt in v])
+    return v
+
+def _load_value(d, fobj):
+    if not isinstance(d, tuple):
+        return d
+    tag = d[0]
+    if tag == 'box':
+        return _load_box(d, fobj)
+    if tag == 'atom':
+        return _load_atom(d[1], fobj)
+    if tag == 'array':
+        a = array(d[1])
+        a.fromstring(d[2])
+        return a
+    if tag == 'table':
+        return iso.Table(*[_load_value(c, fobj) for c in d[1]])
+    if tag == 'list':
+        return [_load_value(elt, fobj) for elt in d[1]]
+    raise ValueError('Unknown index value tag: %r' % (tag,))
+
+def _dump_box(b):
+    fields = [(k, _dump_value(getattr(b, k)))
+              for k in getattr(b, '_fields', ())]
+    return ('box', b.__class__.__name__, _dump_atom(b._atom), fields)
+
+def _load_box(d, fobj):
+    _tag, clsname, ad, fields = d
+    cls = getattr(iso, clsname)
+    return cls(_load_atom(ad, fobj),
+               **dict([(k, _load_value(v, fobj)) for k, v in fields]))
+
+
+class SeekIndex(object):
+    """Loaded seek index of a file."""
+
+    def __init__(self, identity, ftyp, moov, layout, sync_points):
+        self.identity = identity
+        self._ftyp = ftyp
+        self._moov = moov
+        self._layout = layout
+        self._sync_points = sync_points
+
+    @classmethod
+    def from_iso_file(cls, identity, aftyp, amoov, alist):
+        syncs = [_dump_value(t) for t in amoov.get_sync_index().tables]
+        return cls(identity, _dump_box(aftyp), _dump_box(amoov),
+                   [_dump_atom(a) for a in alist], syncs)
+
+    @classmethod
+    def loads(cls, data):
+        identity, size = _unpack_header(data[:_HEADER_SIZE])
+        return cls._load_data(identity, size, data[_HEADER_SIZE:])
+
+    @classmethod
+    def _load_data(cls, identity, size, data):
+        if len(data) != size:
+            raise ValueError('Truncated index: %d bytes of data instead'
+                             ' of %d' % (len(data), size))
+        ftyp, moov, layout, syncs = marshal.loads(data)
+        return cls(identity, ftyp, moov, layout, syncs)
+
+    def dumps(self):
+        data = marshal.dumps((self._ftyp, self._moov, self._layout,
+                              self._sync_points))
+        return _pack_header(self.identity, len(data)) + data
+
+    def bind(self, fobj):
+        """Rebuild the parsed structure of the file, with all the atoms
+        reading their contents from fobj.
+
+        @returns: the same as L{iso.load_iso_file}
+        """
+        amoov = _load_box(self._moov, fobj)
+        syncs = iso.SyncIndex(amoov, [_load_value(d, fobj)
+                                      for d in self._sync_points])
+        amoov._sync_index = syncs
+        return (_load_box(self._ftyp, fobj), amoov,
+                [_load_atom(d, fobj) for d in self._layout], syncs)
+
+    def mdat_offset(self):
+        """Returns the offset of the first 'mdat' atom - all the data
+        needed to split the file is placed before it (or in its
+        header)."""
+        for d in self._layout:
+            if d[2] == 'mdat':
+                return d[3]
+        raise iso.FormatError('No "mdat" atom in index')
+
+    def moov_range(self):
+        """Returns the offset and the end of the 'moov' atom."""
+        for d in self._layout:
+            if d[2] == 'moov':
+                return d[3], d[3] + d[1]
+        raise iso.FormatError('No "moov" atom in index')
+
+    def moov_before_mdat(self):
+        types = [d[2] for d in self._layout]
+        return types.index('moov') < types.index('mdat')
+
+
+def _pack_header(identity, size):
+    values = (_MAGIC, _FORMAT) + _ARRAYS + tuple(identity) + (size,)
+    return struct.pack(_HEADER, *values)
+
+def _unpack_header(data):
+    """Returns the identity of the indexed file and the size of the
+    index data, from the header of an index.
+
+    @raise ValueError: if the header is not one of a usable index
+    """
+    if len(data) != _HEADER_SIZE:
+        raise ValueError('Truncated index header')
+    values = struct.unpack(_HEADER, data)
+    if values[0] != _MAGIC or values[1] != _FORMAT:
+        raise ValueError('Unsupported index format')
+    if values[2:5] != _ARRAYS:
+        raise ValueError('Index written on an incompatible platform')
+    return values[5:8], values[8]
+
+def load_path(path, identity=None, index_dir=None):
+    """Load the index of the media file at path, if there is a valid one.
+
+    @param identity: identity of the media file, if already known
+    @type  identity: (int, float, int)
+
+    @rtype: L{SeekIndex} or None
+    """
+    if identity is None:
+        identity = path_identity(path)
+        if identity is None:
+            return None
+    try:
+        f = open(index_path(path, index_dir), 'rb')
+    except IOError:
+        return None
+    try:
+        try:
+            index_identity, size = _unpack_header(f.read(_HEADER_SIZE))
+            if tuple(index_identity) != tuple(identity):
+                return None
+            # a corrupt index only costs parsing the file
+            return SeekIndex._load_data(index_identity, size, f.read())
+        except (ValueError, EOFError, TypeError):
+            return None
+    finally:
+        f.close()
+
+def find_index(fobj, index_dir=None):
+    """Load the index of an open media file, if there is a valid one.
+
+    @rtype: L{SeekIndex} or None
+    """
+    path = getattr(fobj, 'name', None)
+    if not isinstance(path, basestring):
+        return None
+    identity = file_identity(fobj)
+    if identity is None:
+        return None
+    return load_path(path, identity, index_dir)
+
+def write_index(path, index_dir=None):
+    """Parse the media file at path and store its index.
+
+    @returns: path of the written index file
+    @rtype:   str
+    """
+    f = open(path, 'rb')
+    try:
+        identity = file_identity(f)
+        aftyp, amoov, alist = iso.read_iso_file(f)
+        data = SeekIndex.from_iso_file(identity, aftyp, amoov, alist).dumps()
+    finally:
+        f.close()
+
+    ipath = index_path(path, index_dir)
+    fd, temppath = tempfile.mkstemp(dir=os.path.dirname(ipath) or '.')
+    try:
+        fo = os.fdopen(fd, 'wb')
+        fo.write(data)
+        fo.close()
+        # mkstemp creates the file readable by its owner only, give it
+        # the mode open() would have
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temppath, 0666 & ~umask)
+        os.rename(temppath, ipath)
+    except:
+        os.unlink(temppath)
+        raise
+    return ipath
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [-d dir] file [file ...]')
+    parser.add_option('-d', '--index-dir', dest='index_dir', default=None,
+                      help='directory to store the index files in')
+    options, args = parser.parse_args()
+    if not args:
+        parser.error('no files given')
+    failed = False
+    for path in args:
+        try:
+            print write_index(path, options.index_dir)
+        except Exception, e:
+            print >>sys.stderr, '%s: %s' % (path, e)
+            failed = True
+    sys.exit(failed and 1 or 0)
+
+
+if __name__ == '__main__':
+    main()
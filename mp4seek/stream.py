@@ -0,0 +1,272 @@
+"""Streaming access to the seeked output of a file.
+
+L{SplitStream} yields the rewritten header and then the rest of the
+file in bounded chunks, knowing the total output length up front - it
+can be returned directly as the body of a WSGI response (or iterated
+over from any other server) with constant memory use per request:
+
+    def app(environ, start_response):
+        s = SplitStream(open(path, 'rb'), t)
+        start_response('200 OK', [('Content-Type', 'video/mp4'),
+                                  ('Content-Length', str(s.length))])
+        return s
+
+L{SplitFile} (which SplitStream is) is a read-only, seekable view of
+the same output, mapping any range of it onto the rewritten header or
+the original file - which is what serving HTTP Range requests needs:
+
+        r = parse_range(environ.get('HTTP_RANGE'), s.length)
+        if r is not None:
+            start, end = r
+            start_response('206 Partial Content', [
+                ('Content-Type', 'video/mp4'),
+                ('Content-Range', 'bytes %d-%d/%d' % (start, end - 1,
+                                                      s.length)),
+                ('Content-Length', str(end - start))])
+            return RangeBody(s, start, end - start)
+
+(the servers call the close method of the response bodies, which
+L{RangeBody} passes on to the SplitFile - returning the bare iterator
+of L{SplitFile.iter_range} would leave the file open.)
+"""
+
+import os
+import re
+
+import iso
+import transfer
+
+CHUNK_SIZE = 64 * 1024
+
+_RANGE_RE = re.compile(r'^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+def _file_size(fobj):
+    try:
+        return os.fstat(fobj.fileno()).st_size
+    except (AttributeError, ValueError, OSError, IOError):
+        fobj.seek(0, 2)
+        return fobj.tell()
+
+def parse_range(value, length):
+    """Parse the value of an HTTP Range header, for content of the
+    given length.
+
+    Only single byte ranges are handled - anything else (multiple
+    ranges, syntax errors) makes the header ignored, as HTTP allows.
+
+    @returns: (start, end) of the requested range, end exclusive, or
+              None to serve the whole content
+    @rtype:   tuple or None
+
+    @raise ValueError: if the range is not satisfiable (416)
+    """
+    if not value:
+        return None
+    m = _RANGE_RE.match(value)
+    if m is None:
+        return None
+    first, last = m.groups()
+    if not first:
+        if not last:
+            return None
+        # suffix range, the last bytes
+        size = int(last)
+        if size == 0:
+            raise ValueError('Unsatisfiable range: %r' % value)
+        return max(length - size, 0), length
+    start = int(first)
+    end = length
+    if last:
+        if int(last) < start:
+            return None
+        end = min(int(last) + 1, length)
+    if start >= length:
+        raise ValueError('Unsatisfiable range: %r' % value)
+    return start, end
+
+
+class SplitFile(object):
+    """Read-only file-like object with the output of splitting a file.
+
+    The header is computed when the object is created; reads past it
+    are served from the original file, touching only the bytes needed.
+    The object takes over the file object - it gets closed along with
+    it.
+
+    @ivar length: total size of the output
+    @type length: int
+    """
+
+    def __init__(self, f, t, index=None, end_t=None, compact=False):
+        """
+        @param f: file to split
+        @type  f: file
+
+        @param t: split point, in seconds - nearest sync point will be used
+        @type  t: float
+
+        @param index: seek index of the file, see L{iso.load_iso_file}
+        @type  index: L{sidecar.SeekIndex}
+
+        @param end_t: end of the clip, in seconds - up to the end of the
+                      file if None
+        @type  end_t: float
+
+        @param compact: whether to store the sample sizes in the smallest
+                        boxes possible, see L{iso.compact_trak}
+        @type  compact: bool
+        """
+        self.f = f
+        header_f, self.offset, end = iso.split_range(f, t, index=index,
+                                                     end_t=end_t,
+                                                     compact=compact)
+        self.header = header_f.getvalue()
+        if end is None:
+            end = _file_size(f)
+        self.body_size = max(end - self.offset, 0)
+        self.length = len(self.header) + self.body_size
+        self._pos = 0
+
+    def map_range(self, offset, length):
+        """Map a range of the output onto its sources.
+
+        @returns: (source, start, size) pieces making up the range, the
+                  source being None for the header (start relative to
+                  it) or the original file object
+        @rtype:   list
+        """
+        offset = max(offset, 0)
+        end = min(offset + max(length, 0), self.length)
+        pieces = []
+        hsize = len(self.header)
+        if offset < min(hsize, end):
+            pieces.append((None, offset, min(end, hsize) - offset))
+            offset = min(end, hsize)
+        if offset < end:
+            pieces.append((self.f, self.offset + offset - hsize,
+                           end - offset))
+        return pieces
+
+    def read_range(self, offset, length):
+        """Returns length bytes of the output starting at offset (less
+        at the end of it)."""
+        return ''.join(self.iter_range(offset, length, length))
+
+    def iter_range(self, offset, length, chunk_size=CHUNK_SIZE):
+        """Yields the bytes of a range of the output, in chunks of at
+        most chunk_size bytes."""
+        for source, start, size in self.map_range(offset, length):
+            if source is None:
+                yield self.header[start:start + size]
+                continue
+            pos, end = start, start + size
+            while pos < end:
+                source.seek(pos)
+                data = source.read(min(chunk_size, end - pos))
+                if not data:
+                    raise RuntimeError('Not enough data: file truncated'
+                                       ' at %d' % pos)
+                pos += len(data)
+                yield data
+
+    def write_range(self, out_f, offset, length):
+        """Write a range of the output to out_f, copying the data of the
+        original file in the kernel where possible (see
+        L{transfer.copy_range}).
+
+        @returns: number of bytes written
+        @rtype:   int
+        """
+        done = 0
+        for source, start, size in self.map_range(offset, length):
+            if source is None:
+                out_f.write(self.header[start:start + size])
+            else:
+                transfer.copy_range(source, out_f, start, size)
+            done += size
+        return done
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.length
+        if offset < 0:
+            raise IOError('Invalid seek offset: %d' % offset)
+        self._pos = offset
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.length
+        data = self.read_range(self._pos, size)
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+class SplitStream(SplitFile):
+    """Iterable over the output of splitting a file.
+
+    The header is computed when the stream is created; the body is
+    read from the file lazily, one chunk at a time. The stream takes
+    over the file object - it gets closed along with the stream.
+
+    @ivar length: total number of bytes the stream will yield
+    @type length: int
+    """
+
+    def __init__(self, f, t, chunk_size=CHUNK_SIZE, index=None, end_t=None,
+                 compact=False):
+        """
+        @param f: file to split
+        @type  f: file
+
+        @param t: split point, in seconds - nearest sync point will be used
+        @type  t: float
+
+        @param chunk_size: maximum size of the body chunks
+        @type  chunk_size: int
+
+        @param index: seek index of the file, see L{iso.load_iso_file}
+        @type  index: L{sidecar.SeekIndex}
+
+        @param end_t: end of the clip, in seconds - up to the end of the
+                      file if None
+        @type  end_t: float
+
+        @param compact: whether to store the sample sizes in the smallest
+                        boxes possible, see L{iso.compact_trak}
+        @type  compact: bool
+        """
+        SplitFile.__init__(self, f, t, index, end_t, compact)
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        return self.iter_range(0, self.length)
+
+    def iter_range(self, offset, length, chunk_size=None):
+        return SplitFile.iter_range(self, offset, length,
+                                    chunk_size or self.chunk_size)
+
+
+class RangeBody(object):
+    """Iterable over a range of the output of a L{SplitFile}, closing
+    the SplitFile (and the file it reads from) when closed itself - a
+    WSGI response body for HTTP Range requests."""
+
+    def __init__(self, s, offset, length):
+        self.s = s
+        self.length = length
+        self._chunks = s.iter_range(offset, length)
+
+    def __iter__(self):
+        return self._chunks
+
+    def close(self):
+        self.s.close()
@@ -0,0 +1,200 @@
+"""Copying ranges of file data between file objects.
+
+Whenever both ends are real file descriptors the data is copied inside
+the kernel - with copy_file_range(2) between regular files and
+sendfile(2) to sockets and other targets - falling back to a plain,
+chunked read/write loop otherwise.
+"""
+
+import errno
+import os
+import select
+import stat
+
+BUFFER_SIZE = 64 * 1024
+
+# ranges smaller than that are not worth the extra syscalls
+MIN_KERNEL_COPY = 64 * 1024
+
+# maximum number of bytes the kernel transfers in a single call
+_MAX_CHUNK = 0x7ffff000
+
+# errors meaning the given method can't be used for the given fds
+_UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EBADF,
+                getattr(errno, 'EOPNOTSUPP', errno.EINVAL),
+                getattr(errno, 'ENOTSUP', errno.EINVAL))
+
+
+def _load_libc():
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+    except (ImportError, OSError):
+        return None, None, None
+    return ctypes, libc, ctypes.c_int64
+
+_ctypes, _libc, _c_off_t = _load_libc()
+
+def _libc_func(name, argtypes):
+    if _libc is None:
+        return None
+    func = getattr(_libc, name, None)
+    if func is not None:
+        func.argtypes = argtypes
+        func.restype = _ctypes.c_ssize_t
+    return func
+
+if _libc is not None:
+    _c_sendfile = (_libc_func('sendfile64', [_ctypes.c_int, _ctypes.c_int,
+                                             _ctypes.POINTER(_c_off_t),
+                                             _ctypes.c_size_t]) or
+                   _libc_func('sendfile', [_ctypes.c_int, _ctypes.c_int,
+                                           _ctypes.POINTER(_c_off_t),
+                                           _ctypes.c_size_t]))
+    _c_copy_file_range = _libc_func('copy_file_range',
+                                    [_ctypes.c_int, _ctypes.POINTER(_c_off_t),
+                                     _ctypes.c_int, _ctypes.POINTER(_c_off_t),
+                                     _ctypes.c_size_t, _ctypes.c_uint])
+    _c_fallocate = (_libc_func('fallocate64', [_ctypes.c_int, _ctypes.c_int,
+                                               _c_off_t, _c_off_t]) or
+                    _libc_func('fallocate', [_ctypes.c_int, _ctypes.c_int,
+                                             _c_off_t, _c_off_t]))
+    if _c_fallocate is not None:
+        _c_fallocate.restype = _ctypes.c_int
+else:
+    _c_sendfile = _c_copy_file_range = _c_fallocate = None
+
+# see linux/falloc.h
+FALLOC_FL_INSERT_RANGE = 0x20
+
+def _check_result(res):
+    if res < 0:
+        err = _ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return res
+
+def _sendfile(out_fd, in_fd, offset, count):
+    if hasattr(os, 'sendfile'):
+        return os.sendfile(out_fd, in_fd, offset, count)
+    if _c_sendfile is None:
+        raise OSError(errno.ENOSYS, 'sendfile not available')
+    return _check_result(_c_sendfile(out_fd, in_fd,
+                                     _ctypes.byref(_c_off_t(offset)), count))
+
+def _copy_file_range(out_fd, in_fd, offset, count):
+    if hasattr(os, 'copy_file_range'):
+        return os.copy_file_range(in_fd, out_fd, count, offset)
+    if _c_copy_file_range is None:
+        raise OSError(errno.ENOSYS, 'copy_file_range not available')
+    return _check_result(_c_copy_file_range(in_fd,
+                                            _ctypes.byref(_c_off_t(offset)),
+                                            out_fd, None, count, 0))
+
+def insert_range(fd, offset, length):
+    """Insert a hole of length bytes at offset into the file, moving
+    the data following it - without copying, with fallocate(2).
+
+    Both offset and length have to be multiples of the filesystem
+    block size, and offset has to be inside the file.
+
+    @raise OSError: also with one of ENOSYS, EOPNOTSUPP or EINVAL if the
+                    operation is not supported for the file
+    """
+    if _c_fallocate is None:
+        raise OSError(errno.ENOSYS, 'fallocate not available')
+    _check_result(_c_fallocate(fd, FALLOC_FL_INSERT_RANGE, offset, length))
+
+def _fileno(fobj):
+    try:
+        return fobj.fileno()
+    except (AttributeError, ValueError, IOError):
+        return None
+
+def _kernel_copy(method, out_fd, in_fd, offset, count):
+    """Copy with the given method as much as possible.
+
+    @returns: number of bytes copied, before running out of data or
+              finding out the method can't be used
+    """
+    done = 0
+    while done < count:
+        try:
+            n = method(out_fd, in_fd, offset + done,
+                       min(count - done, _MAX_CHUNK))
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                select.select([], [out_fd], [])
+                continue
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno in _UNSUPPORTED:
+                break
+            raise
+        if n == 0:
+            break
+        done += n
+    return done
+
+def _userspace_copy(in_f, out_f, offset, count):
+    in_f.seek(offset)
+    # raw sockets have no write, only sendall
+    write = getattr(out_f, 'write', None) or out_f.sendall
+    done = 0
+    while count is None or done < count:
+        size = BUFFER_SIZE
+        if count is not None:
+            size = min(size, count - done)
+        buf = in_f.read(size)
+        if not buf:
+            break
+        write(buf)
+        done += len(buf)
+    return done
+
+def copy_range(in_f, out_f, offset, count=None):
+    """Copy count bytes starting at offset in in_f to the current
+    position of out_f - a file object, or a socket.
+
+    @param count: number of bytes to copy - everything up to the end of
+                  in_f if None
+    @type  count: int or None
+
+    @returns: number of bytes copied
+    @rtype:   int
+    """
+    in_fd, out_fd = _fileno(in_f), _fileno(out_f)
+    done = 0
+
+    if in_fd is not None and out_fd is not None:
+        to_copy = count
+        if to_copy is None:
+            to_copy = max(os.fstat(in_fd).st_size - offset, 0)
+        if to_copy >= MIN_KERNEL_COPY:
+            # raw sockets have nothing to flush
+            flush = getattr(out_f, 'flush', None)
+            if flush is not None:
+                flush()
+            out_mode = os.fstat(out_fd).st_mode
+            if stat.S_ISREG(out_mode):
+                done = _kernel_copy(_copy_file_range, out_fd, in_fd, offset,
+                                    to_copy)
+            if done < to_copy:
+                done += _kernel_copy(_sendfile, out_fd, in_fd, offset + done,
+                                     to_copy - done)
+            if stat.S_ISREG(out_mode):
+                # file objects may cache the position, resync them
+                out_f.seek(os.lseek(out_fd, 0, 1))
+
+    rest = None
+    if count is not None:
+        rest = count - done
+    if rest is None or rest > 0:
+        done += _userspace_copy(in_f, out_f, offset + done, rest)
+    in_f.seek(offset + done)
+
+    if count is not None and done != count:
+        raise RuntimeError('Not enough data: requested %d, read %d' %
+                           (count, done))
+    return done
@@ -0,0 +1,159 @@
+"""Whole-table operations on the sample tables.
+
+NumPy is used when it is installed; otherwise the work is done with
+the L{array} module, keeping the per-element loops in C where possible.
+"""
+
+from array import array
+from itertools import imap, islice, repeat
+import operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _as_numpy(a):
+    if not len(a):
+        return numpy.zeros(0, dtype=a.typecode)
+    return numpy.frombuffer(a, dtype=a.typecode)
+
+def _from_numpy(typecode, v):
+    return array(typecode, v.astype(typecode).tostring())
+
+def _use_numpy(a):
+    return numpy is not None and isinstance(a, array)
+
+def add(a, n):
+    """Returns a new table with n added to all the values of table a.
+
+    @raise OverflowError: if the results don't fit in the type of a
+    """
+    if not n:
+        return a[:]
+    if _use_numpy(a):
+        v = _as_numpy(a).astype(numpy.int64) + n
+        if len(v) and (v.min() < 0 or (a.itemsize < 8 and
+                                       v.max() >> (8 * a.itemsize))):
+            raise OverflowError('table values out of range after adding %d'
+                                % n)
+        return _from_numpy(a.typecode, v)
+    values = imap(operator.add, a, repeat(n))
+    if isinstance(a, array):
+        return array(a.typecode, values)
+    return list(values)
+
+def cumsum(typecode, values, start):
+    """Returns a table of len(values) + 1 partial sums of values, the
+    first one being start."""
+    if numpy is not None and typecode is not None:
+        v = numpy.empty(len(values) + 1, dtype=numpy.uint64)
+        v[0] = start
+        if len(values):
+            numpy.cumsum(_as_numpy(values), dtype=numpy.uint64, out=v[1:])
+            v[1:] += start
+        return _from_numpy(typecode, v)
+    sums = [start]
+    total = start
+    for value in values:
+        total += value
+        sums.append(total)
+    if typecode is None:
+        return sums
+    return array(typecode, sums)
+
+def multiply(typecode, a, b):
+    """Returns a table of element-wise products of tables a and b."""
+    if _use_numpy(a) and _use_numpy(b) and typecode is not None:
+        return _from_numpy(typecode, _as_numpy(a).astype(numpy.uint64) *
+                           _as_numpy(b))
+    values = imap(operator.mul, a, b)
+    if typecode is None:
+        return list(values)
+    return array(typecode, values)
+
+def diff(typecode, a):
+    """Returns a table of len(a) - 1 differences of the consecutive
+    values of table a."""
+    if _use_numpy(a) and typecode is not None:
+        return _from_numpy(typecode, numpy.diff(_as_numpy(a)))
+    values = imap(operator.sub, islice(a, 1, None), a)
+    if typecode is None:
+        return list(values)
+    return array(typecode, values)
+
+def mediatimes(starts, times, deltas, samples):
+    """Convert (sorted) sample numbers to media times, given the
+    cumulative index of the 'stts' table (see L{iso.build_sctts_index})
+    and the sample deltas of the runs."""
+    n = len(deltas)
+    if (numpy is not None and isinstance(samples, array) and
+        isinstance(starts, array) and isinstance(times, array)):
+        s = _as_numpy(samples).astype(numpy.int64)
+        st = _as_numpy(starts).astype(numpy.int64)
+        i = numpy.searchsorted(st[1:], s, side='left')
+        ended = i >= n
+        i = numpy.minimum(i, max(n - 1, 0))
+        if n:
+            d = _as_numpy(deltas).astype(numpy.int64)[i]
+        else:
+            d = numpy.zeros(len(s), dtype=numpy.int64)
+        t = _as_numpy(times).astype(numpy.int64)
+        mts = t[i] + (s - st[i]) * d
+        mts[ended] = t[n]
+        return _from_numpy(times.typecode, mts)
+
+    from bisect import bisect_left
+    ret = []
+    for sample in samples:
+        i = bisect_left(starts, sample, 1) - 1
+        if i >= n:
+            ret.append(times[n])
+        else:
+            ret.append(times[i] + (sample - starts[i]) * deltas[i])
+    if isinstance(times, array):
+        return array(times.typecode, ret)
+    return ret
+
+def maximum(a):
+    """Returns the largest value of table a, 0 if it is empty."""
+    if not len(a):
+        return 0
+    if _use_numpy(a):
+        return int(_as_numpy(a).max())
+    return max(a)
+
+# translation tables extracting the high and the low nibbles of bytes
+_HIGH_NIBBLES = ''.join([chr(i >> 4) for i in xrange(256)])
+_LOW_NIBBLES = ''.join([chr(i & 0x0f) for i in xrange(256)])
+
+def unpack_nibbles(data, count):
+    """Unpack count 4-bit values from a string (or buffer) holding two
+    of them per byte, the high nibble first, into an array of bytes."""
+    data = str(data)
+    values = array('B', [0]) * (2 * len(data))
+    values[0::2] = array('B', data.translate(_HIGH_NIBBLES))
+    values[1::2] = array('B', data.translate(_LOW_NIBBLES))
+    del values[count:]
+    return values
+
+def pack_nibbles(a):
+    """Pack the 4-bit values of table a two per byte, the high nibble
+    first - the reverse of L{unpack_nibbles}.
+
+    @returns: the packed values, padded with a zero nibble to a whole
+              number of bytes
+    @rtype:   str
+    """
+    if len(a) % 2:
+        a = a[:]
+        a.append(0)
+    if _use_numpy(a):
+        v = _as_numpy(a).astype(numpy.uint8)
+        return (((v[0::2] & 0x0f) << 4) | (v[1::2] & 0x0f)).tostring()
+    high = imap(operator.lshift,
+                imap(operator.and_, islice(a, 0, None, 2), repeat(0x0f)),
+                repeat(4))
+    low = imap(operator.and_, islice(a, 1, None, 2), repeat(0x0f))
+    return array('B', imap(operator.or_, high, low)).tostring()
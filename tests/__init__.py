@@ -0,0 +1,7 @@
+"""Tests of the mp4seek package, on files generated with
+L{benchmarks.synth}.
+
+Run from the top of the source tree:
+
+    python -m unittest tests.test_clip
+"""
@@ -0,0 +1,48 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from benchmarks import synth
+from mp4seek import async
+from mp4seek import iso
+
+
+class ClipRangeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'clip.mp4')
+        synth.make(self.path, samples=250)
+        self.f = open(self.path, 'rb')
+
+    def tearDown(self):
+        self.f.close()
+        shutil.rmtree(self.dir)
+
+    def test_end_before_start(self):
+        self.assertRaises(ValueError, iso.split_range, self.f, 3.3,
+                          end_t=2.0)
+
+    def test_end_at_start(self):
+        self.assertRaises(ValueError, iso.split_range, self.f, 3.3,
+                          end_t=3.3)
+
+    def test_many(self):
+        self.assertRaises(ValueError, iso.split_many, self.f, [1.0, 3.3],
+                          end_times=[2.0, 2.0])
+
+    def test_clip_moov(self):
+        aftyp, amoov, alist = iso.read_iso_file(self.f)
+        self.assertRaises(ValueError, iso.clip_moov, amoov, 3.3, 2.0)
+
+    def test_splitter(self):
+        self.assertRaises(ValueError, async.Splitter, 3.3, end_t=2.0)
+
+    def test_clip(self):
+        out_f, start, end = iso.split_range(self.f, 3.3, end_t=5.0)
+        self.failUnless(start < end)
+
+
+if __name__ == '__main__':
+    unittest.main()